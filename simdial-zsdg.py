@@ -4,8 +4,9 @@ from __future__ import print_function
 
 from zsdg.dataset.corpora import SimDialCorpus, SYS
 from zsdg.dataset.data_loaders import SimDialDataLoader
+from zsdg.dataset.async_loaders import prefetch
 from zsdg.models import models
-from zsdg.main import train, validate
+from zsdg.main import train, validate, resume_checkpoint
 from zsdg import hred_utils
 from zsdg.utils import str2bool, prepare_dirs_loggers, get_time, process_config
 from zsdg.evaluators import TurnEvaluator
@@ -44,6 +45,21 @@ data_arg.add_argument('--test_dir', type=str, nargs='+', default=['data/simdial/
                                                                   'data/simdial/test/restaurant_style-MixSpec-500.json'])
 
 data_arg.add_argument('--log_dir', type=str, default='logs')
+data_arg.add_argument('--use_cache', type=str2bool, default=True)
+data_arg.add_argument('--cache_dir', type=str, default='data/cache')
+data_arg.add_argument('--preprocess_workers', type=int, default=1)
+data_arg.add_argument('--compact_corpus', type=str2bool, default=False)
+data_arg.add_argument('--prefetch_depth', type=int, default=0)
+data_arg.add_argument('--batch_workers', type=int, default=0)
+data_arg.add_argument('--batch_sampler', type=str, default='default', choices=['default', 'bucket'])
+data_arg.add_argument('--max_tokens_per_batch', type=int, default=0)
+data_arg.add_argument('--batch_buffers', type=str2bool, default=False)
+data_arg.add_argument('--pin_batches', type=str2bool, default=False)
+data_arg.add_argument('--batch_tensors', type=str2bool, default=False)
+data_arg.add_argument('--warmup_ratio', type=float, default=0.0)
+data_arg.add_argument('--rank', type=int, default=0)
+data_arg.add_argument('--world_size', type=int, default=1)
+data_arg.add_argument('--cache_eval_batches', type=str2bool, default=False)
 
 # Network
 net_arg = add_argument_group('Network')
@@ -87,6 +103,7 @@ misc_arg.add_argument('--save_model', type=str2bool, default=True)
 misc_arg.add_argument('--use_gpu', type=str2bool, default=True)
 misc_arg.add_argument('--print_step', type=int, default=200)
 misc_arg.add_argument('--ckpt_step', type=int, default=1000)
+misc_arg.add_argument('--resume_step', type=int, default=0)
 misc_arg.add_argument('--batch_size', type=int, default=20)
 misc_arg.add_argument('--gen_type', type=str, default='greedy')
 misc_arg.add_argument('--avg_type', type=str, default='word')
@@ -106,12 +123,21 @@ net_arg.add_argument('--use_ptr', type=str2bool, default=True)
 # Where to load existing model
 misc_arg.add_argument('--forward_only', type=str2bool, default=False)
 misc_arg.add_argument('--load_sess', type=str, default="ENTER_YOUR_PATH_HERE")
+# Where to resume an interrupted training, e.g. a preempted job
+misc_arg.add_argument('--resume_sess', type=str, default=None)
 
 
 def main(config):
     prepare_dirs_loggers(config, os.path.basename(__file__))
 
-    corpus_client = SimDialCorpus(config)
+    if config.forward_only:
+        # only the test split is read if the session saved its corpus
+        corpus_client = SimDialCorpus(config, session_dir=os.path.join(config.log_dir, config.load_sess))
+    else:
+        corpus_client = SimDialCorpus(config)
+        # a resumed run keeps the session it continues, load_checkpoint checks the corpus matches
+        if resume_checkpoint(config) is None:
+            corpus_client.save_session(config.session_dir)
     domain_meta = corpus_client.get_domain_meta()
     warmup_data = corpus_client.get_seed_responses(config.target_example_cnt, None)
     dial_corpus = corpus_client.get_dialog_corpus()
@@ -122,9 +148,14 @@ def main(config):
     evaluator = TurnEvaluator("EMPTY", corpus_client.get_turn_corpus(SYS), corpus_client.domain_meta)
 
     # create data loader that feed the deep models
-    train_feed = SimDialDataLoader("Train", train_dial, domain_meta, config, warmup_data)
-    valid_feed = SimDialDataLoader("Valid", valid_dial, domain_meta, config)
+    if config.forward_only:
+        train_feed, valid_feed = None, None
+    else:
+        train_feed = SimDialDataLoader("Train", train_dial, domain_meta, config, warmup_data)
+        valid_feed = SimDialDataLoader("Valid", valid_dial, domain_meta, config)
     test_feed = SimDialDataLoader("Test", test_dial, domain_meta, config)
+    train_feed, valid_feed, test_feed = prefetch(train_feed, config), prefetch(valid_feed, config), \
+                                        prefetch(test_feed, config)
     if config.action_match:
         if config.use_ptr:
             model = models.ZeroShotPtrHRED(corpus_client, config)
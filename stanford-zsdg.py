@@ -4,8 +4,9 @@ from __future__ import print_function
 
 from zsdg.dataset.corpora import ZslStanfordCorpus, SYS
 from zsdg.dataset import data_loaders
+from zsdg.dataset.async_loaders import prefetch
 from zsdg.models import models
-from zsdg.main import train, validate
+from zsdg.main import train, validate, resume_checkpoint
 from zsdg import hred_utils
 from zsdg.utils import str2bool, prepare_dirs_loggers, get_time, process_config
 from zsdg import evaluators
@@ -46,6 +47,21 @@ def get_config():
 data_arg = add_argument_group('Data')
 data_arg.add_argument('--data_dir', type=str, nargs='+', default=['data/stanford'])
 data_arg.add_argument('--log_dir', type=str, default='logs')
+data_arg.add_argument('--use_cache', type=str2bool, default=True)
+data_arg.add_argument('--cache_dir', type=str, default='data/cache')
+data_arg.add_argument('--preprocess_workers', type=int, default=1)
+data_arg.add_argument('--compact_corpus', type=str2bool, default=False)
+data_arg.add_argument('--prefetch_depth', type=int, default=0)
+data_arg.add_argument('--batch_workers', type=int, default=0)
+data_arg.add_argument('--batch_sampler', type=str, default='default', choices=['default', 'bucket'])
+data_arg.add_argument('--max_tokens_per_batch', type=int, default=0)
+data_arg.add_argument('--batch_buffers', type=str2bool, default=False)
+data_arg.add_argument('--pin_batches', type=str2bool, default=False)
+data_arg.add_argument('--batch_tensors', type=str2bool, default=False)
+data_arg.add_argument('--warmup_ratio', type=float, default=0.0)
+data_arg.add_argument('--rank', type=int, default=0)
+data_arg.add_argument('--world_size', type=int, default=1)
+data_arg.add_argument('--cache_eval_batches', type=str2bool, default=False)
 
 # Network
 net_arg = add_argument_group('Network')
@@ -89,6 +105,7 @@ misc_arg.add_argument('--save_model', type=str2bool, default=True)
 misc_arg.add_argument('--use_gpu', type=str2bool, default=True)
 misc_arg.add_argument('--print_step', type=int, default=100)
 misc_arg.add_argument('--ckpt_step', type=int, default=400)
+misc_arg.add_argument('--resume_step', type=int, default=0)
 misc_arg.add_argument('--batch_size', type=int, default=20)
 misc_arg.add_argument('--gen_type', type=str, default='greedy')
 misc_arg.add_argument('--avg_type', type=str, default='word')
@@ -108,13 +125,22 @@ net_arg.add_argument('--use_ptr', type=str2bool, default=True)
 # Where to load existing model
 misc_arg.add_argument('--forward_only', type=str2bool, default=False)
 misc_arg.add_argument('--load_sess', type=str, default="ENTER_YOUR_PATH_HERE")
+# Where to resume an interrupted training, e.g. a preempted job
+misc_arg.add_argument('--resume_sess', type=str, default=None)
 
 
 def main(config):
     prepare_dirs_loggers(config, os.path.basename(__file__))
 
     # Load dataset
-    corpus_client = ZslStanfordCorpus(config)
+    if config.forward_only:
+        # only the test split is read if the session saved its corpus
+        corpus_client = ZslStanfordCorpus(config, session_dir=os.path.join(config.log_dir, config.load_sess))
+    else:
+        corpus_client = ZslStanfordCorpus(config)
+        # a resumed run keeps the session it continues, load_checkpoint checks the corpus matches
+        if resume_checkpoint(config) is None:
+            corpus_client.save_session(config.session_dir)
     # Get seed responses
     warmup_data = corpus_client.get_seed_responses(config.target_example_cnt)
     dial_corpus = corpus_client.get_corpus()
@@ -125,9 +151,15 @@ def main(config):
     evaluator = evaluators.BleuEntEvaluator("SMD", corpus_client.ent_metas)
 
     # create data loader that feed the deep models
-    train_feed = data_loaders.ZslSMDDialDataLoader("Train", train_dial, config, warmup_data)
-    valid_feed = data_loaders.ZslSMDDialDataLoader("Valid", valid_dial, config)
-    test_feed = data_loaders.ZslSMDDialDataLoader("Test", test_dial, config)
+    if config.forward_only:
+        train_feed, valid_feed = None, None
+    else:
+        train_feed = data_loaders.ZslSMDDialDataLoader("Train", train_dial, corpus_client.kb_table, config,
+                                                       warmup_data)
+        valid_feed = data_loaders.ZslSMDDialDataLoader("Valid", valid_dial, corpus_client.kb_table, config)
+    test_feed = data_loaders.ZslSMDDialDataLoader("Test", test_dial, corpus_client.kb_table, config)
+    train_feed, valid_feed, test_feed = prefetch(train_feed, config), prefetch(valid_feed, config), \
+                                        prefetch(test_feed, config)
     if config.action_match:
         if config.use_ptr:
             model = models.ZeroShotPtrHRED(corpus_client, config)
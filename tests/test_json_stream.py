@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+
+import io
+import json
+
+import pytest
+
+from zsdg.utils import iter_json_items
+
+DOCS = [u'{"a": 0.25, "dialogs": [1.5, [1,2], {"x":"y"}]}',
+        u'{"dialogs": [-3, 2e10, 1E-3, true, null, "0.5"], "b": 12.5e+2, "c": [0.125]}',
+        u'{ "dialogs" : [ ] , "n" : 7 }',
+        u'{}']
+
+
+def _collect(path, chunk_size):
+    value = {}
+    for key, item in iter_json_items(path, 'dialogs', chunk_size=chunk_size):
+        if key == 'dialogs':
+            value.setdefault(key, []).append(item)
+        else:
+            value[key] = item
+    return value
+
+
+@pytest.mark.parametrize('doc', DOCS)
+@pytest.mark.parametrize('chunk_size', [1, 2, 3, 4, 5, 8, 13, 1 << 16])
+def test_iter_json_items_matches_json_load(tmpdir, doc, chunk_size):
+    path = str(tmpdir.join('doc.json'))
+    with io.open(path, 'w', encoding='utf-8') as f:
+        f.write(doc)
+    expected = json.loads(doc)
+    if expected.get('dialogs') == []:
+        # an empty streamed list yields nothing
+        del expected['dialogs']
+    assert _collect(path, chunk_size) == expected
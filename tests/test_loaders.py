@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+
+from argparse import Namespace
+
+import numpy as np
+import pytest
+
+from zsdg.utils import Pack
+from zsdg.dataset.corpora import SYS, USR
+from zsdg.dataset.compact_corpus import CompactDialogCorpus, KBTable
+from zsdg.dataset.dataloader_bases import LongDataLoader
+from zsdg.dataset.data_loaders import SimDialDataLoader, ZslSMDDialDataLoader
+from zsdg.dataset.async_loaders import prefetch
+
+MAX_UTT_LEN = 8
+DOMAINS = ['bus', 'weather', 'movie']
+
+
+class _GridLoader(LongDataLoader):
+    def __init__(self, data_lens):
+        super(_GridLoader, self).__init__("Grid")
+        self.data_lens = data_lens
+        self.data_size = len(data_lens)
+        self.indexes = list(np.argsort(data_lens))[::-1]
+        self.max_utt_size = 10
+
+
+def _reference_grids(data_lens, batch_indexes, backward_size, step_size):
+    # the windows of every batch as the per batch loop computed them before _grid_table
+    grid_indexes = []
+    for idx, b_ids in enumerate(batch_indexes):
+        max_len = data_lens[b_ids[0]]
+        min_len = data_lens[b_ids[-1]]
+        num_seg = (max_len - backward_size - step_size) // step_size
+        cut_start, cut_end = [], []
+        if num_seg > 1:
+            cut_start = list(range(step_size, num_seg * step_size, step_size))
+            cut_end = list(range(backward_size + step_size, num_seg * step_size + backward_size, step_size))
+            assert cut_end[-1] < max_len
+
+        actual_size = min(max_len, backward_size)
+        temp_end = list(range(2, actual_size, step_size))
+        temp_start = [0] * len(temp_end)
+
+        cut_start = temp_start + cut_start
+        cut_end = temp_end + cut_end
+        grid_indexes.extend([(idx, s_id, e_id) for s_id, e_id in zip(cut_start, cut_end)
+                             if s_id < min_len - 1])
+    return grid_indexes
+
+
+@pytest.mark.parametrize('seed', range(40))
+def test_grid_table_matches_per_batch_loop(seed):
+    rng = np.random.RandomState(seed)
+    data_lens = rng.randint(1, rng.choice([5, 30, 200]), size=rng.randint(1, 300)).tolist()
+    step_size = int(rng.choice([1, 2, 3, 5]))
+    config = Namespace(batch_size=rng.randint(1, 40), backward_size=step_size * rng.randint(1, 8),
+                       step_size=step_size, max_tokens_per_batch=int(rng.choice([0, 0, 500, 3000])))
+    loader = _GridLoader(data_lens)
+    loader.epoch_init(config, shuffle=False, verbose=False)
+    expected = _reference_grids(data_lens, loader.batch_indexes, config.backward_size, config.step_size)
+    assert [tuple(g) for g in loader.grid_indexes] == expected
+
+
+def _utt(rng, speaker):
+    utt = rng.randint(4, 50, size=rng.randint(3, MAX_UTT_LEN + 4)).tolist()
+    return [1 if speaker == USR else 2] + utt + [3]
+
+
+def _sim_data(rng):
+    dialogs = []
+    for _ in range(37):
+        dialog = []
+        for t_id in range(rng.randint(2, 24)):
+            speaker = SYS if t_id % 2 == 0 else USR
+            dialog.append(Pack(utt=_utt(rng, speaker), speaker=speaker, conf=float(rng.rand()),
+                               domain=DOMAINS[rng.randint(len(DOMAINS))],
+                               actions=rng.randint(4, 50, size=rng.randint(0, 5)).tolist()))
+        dialogs.append(dialog)
+
+    domain_meta = Pack(sys_id=2, usr_id=1)
+    for domain in DOMAINS:
+        templates = [_utt(rng, SYS if i % 2 == 0 else USR) for i in range(4)]
+        domain_meta[domain] = Pack(templates=templates, acts=[[i] for i in range(4)],
+                                   description=rng.randint(4, 50, size=5).tolist())
+    warmup_data = [Pack(domain=DOMAINS[i % len(DOMAINS)], utt=_utt(rng, SYS),
+                        actions=rng.randint(4, 50, size=rng.randint(1, 4)).tolist()) for i in range(45)]
+    return dialogs, domain_meta, warmup_data
+
+
+def _smd_data(rng):
+    kb_table = KBTable.from_matrices([rng.randint(4, 50, size=(rng.randint(1, 6), MAX_UTT_LEN)).astype(np.int32)
+                                      for _ in range(5)], MAX_UTT_LEN)
+    dialogs = []
+    for _ in range(29):
+        kb_id = rng.randint(-1, len(kb_table))
+        domain_id = rng.randint(len(DOMAINS))
+        dialog = []
+        for t_id in range(rng.randint(2, 12)):
+            speaker = USR if t_id % 2 == 0 else SYS
+            dialog.append(Pack(utt=_utt(rng, speaker), speaker=speaker, kb_id=kb_id,
+                               domain=DOMAINS[domain_id], domain_id=domain_id))
+        dialogs.append(dialog)
+    warmup_data = [Pack(domain=DOMAINS[i % len(DOMAINS)], domain_id=i % len(DOMAINS), utt=_utt(rng, SYS),
+                        actions=rng.randint(4, 50, size=rng.randint(1, 4)).tolist()) for i in range(45)]
+    return dialogs, kb_table, warmup_data
+
+
+def _config(**kwargs):
+    config = Namespace(max_utt_len=MAX_UTT_LEN, batch_size=5, backward_size=6, step_size=2)
+    for key, value in kwargs.items():
+        setattr(config, key, value)
+    return config
+
+
+def _make_sim(config, compact=False):
+    dialogs, domain_meta, warmup_data = _sim_data(np.random.RandomState(0))
+    if compact:
+        dialogs = CompactDialogCorpus.from_dialogs(dialogs)
+    return SimDialDataLoader("Train", dialogs, domain_meta, config, warmup_data)
+
+
+def _make_smd(config, compact=False):
+    dialogs, kb_table, warmup_data = _smd_data(np.random.RandomState(0))
+    if compact:
+        dialogs = CompactDialogCorpus.from_dialogs(dialogs)
+    return ZslSMDDialDataLoader("Train", dialogs, kb_table, config, warmup_data)
+
+
+def _epoch(feed, config):
+    # the warm up batches are drawn even without shuffling
+    np.random.seed(1)
+    feed.epoch_init(config, shuffle=False, verbose=False)
+    batches = []
+    while True:
+        batch = feed.next_batch()
+        if batch is None:
+            return batches
+        # buffers are reused by later batches, copy the values out
+        batches.append({k: np.asarray(v).tolist() for k, v in batch.items()})
+
+
+OPTIONS = [dict(prefetch_depth=2),
+           dict(batch_workers=2),
+           dict(batch_buffers=True),
+           dict(batch_buffers=True, prefetch_depth=2),
+           dict(batch_tensors=True),
+           dict(cache_eval_batches=True),
+           dict(cache_eval_batches=True, batch_workers=2),
+           dict(compact_corpus=True)]
+
+
+@pytest.mark.parametrize('make', [_make_sim, _make_smd], ids=['simdial', 'smd'])
+@pytest.mark.parametrize('options', OPTIONS, ids=lambda o: ','.join(sorted(o)))
+def test_loader_options_keep_the_batches(make, options):
+    config = _config()
+    expected = _epoch(make(config), config)
+    assert len(expected) > 0
+
+    config = _config(**options)
+    feed = prefetch(make(config, compact=options.get('compact_corpus', False)), config)
+    try:
+        # the second epoch is served from the batch cache, if any
+        for _ in range(2):
+            assert _epoch(feed, config) == expected
+    finally:
+        if hasattr(feed, 'close'):
+            feed.close()
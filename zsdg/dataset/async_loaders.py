@@ -0,0 +1,350 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+
+import logging
+import multiprocessing
+import sys
+import threading
+import time
+import traceback
+
+import numpy as np
+
+from zsdg.utils import Pack
+from zsdg.dataset.batch_buffers import to_tensors
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+
+class _Failure(object):
+    """An exception raised by the producer, re-raised in the consumer"""
+
+    def __init__(self, exc_info):
+        self.exc_info = exc_info
+
+
+class PrefetchLoader(object):
+    """
+    Wrap a DataLoader or LongDataLoader so that the batches of an epoch are
+    built by a background thread while the model consumes the previous
+    ones. epoch_init still runs on the caller's thread, so the random
+    shuffling, the warm up flags and the batch order are the same as the
+    wrapped loader's, only the batch construction is moved. A cached epoch
+    of the wrapped loader whose batches are all built is served directly.
+
+    :ivar loader: the wrapped data loader
+    :ivar depth: at most this many batches wait in the queue
+    :ivar ptr: the number of batches handed out in this epoch
+    :ivar wait_time: the seconds next_batch blocked on an empty queue this epoch
+    """
+    logger = logging.getLogger()
+
+    def __init__(self, loader, depth=2):
+        self.loader = loader
+        self.depth = max(1, depth)
+        self.ptr = 0
+        self.wait_time = 0.0
+        self._queue = None
+        self._stop = None
+        self._worker = None
+        self._verbose = False
+        self._direct = False
+
+    def __getattr__(self, name):
+        # only called for attributes the wrapper does not have
+        if name == 'loader':
+            raise AttributeError(name)
+        return getattr(self.loader, name)
+
+    def _produce(self, q, stop, start, num_batch):
+        try:
+            for ptr in range(start, num_batch):
+                batch = self.loader._make_batch(ptr)
+                while not stop.is_set():
+                    try:
+                        q.put(batch, timeout=0.1)
+                        break
+                    except queue.Full:
+                        continue
+                if stop.is_set():
+                    return
+        except Exception:
+            q.put(_Failure(sys.exc_info()))
+
+    def close(self):
+        """Stop the producer of the current epoch and drop its batches"""
+        if self._worker is None:
+            return
+        self._stop.set()
+        # unblock a producer waiting on a full queue
+        while self._worker.is_alive():
+            try:
+                self._queue.get_nowait()
+            except queue.Empty:
+                pass
+            self._worker.join(0.05)
+        self._worker, self._queue, self._stop = None, None, None
+
+    def epoch_init(self, config, shuffle=True, verbose=True):
+        self.close()
+        self.loader.epoch_init(config, shuffle=shuffle, verbose=verbose)
+        self._start(0, verbose)
+
+    def _start(self, ptr, verbose):
+        self.ptr = ptr
+        self.wait_time = 0.0
+        self._verbose = verbose
+        # nothing left to build, the batches come from the cache
+        self._direct = self.loader._cache_complete()
+        if self._direct:
+            return
+
+        self._queue = queue.Queue(maxsize=self.depth)
+        self._stop = threading.Event()
+        self._worker = threading.Thread(target=self._produce,
+                                        args=(self._queue, self._stop, ptr, self.loader.num_batch))
+        self._worker.daemon = True
+        self._worker.start()
+
+    def state_dict(self):
+        # the wrapped loader is ahead by the prefetched batches, ptr is ours
+        state = self.loader.state_dict()
+        state['ptr'] = self.ptr
+        return state
+
+    def load_state_dict(self, state):
+        self.close()
+        self.loader.load_state_dict(state)
+        self._start(state['ptr'], False)
+
+    def _next_cached(self):
+        if self.ptr >= self.loader.num_batch:
+            return None
+        self.ptr += 1
+        return self.loader._make_batch(self.ptr - 1)
+
+    def next_batch(self):
+        if self._direct:
+            return self._next_cached()
+        if self._worker is None or self.ptr >= self.loader.num_batch:
+            return None
+
+        start = time.time()
+        try:
+            # a timeout keeps the wait interruptible by Ctrl-C
+            while True:
+                try:
+                    batch = self._queue.get(timeout=0.1)
+                    break
+                except queue.Empty:
+                    continue
+        except KeyboardInterrupt:
+            self.close()
+            raise
+        self.wait_time += time.time() - start
+
+        if isinstance(batch, _Failure):
+            self.close()
+            raise batch.exc_info[1]
+
+        self.ptr += 1
+        if self.ptr == self.loader.num_batch:
+            self._worker.join()
+            self._worker, self._queue, self._stop = None, None, None
+            if self._verbose:
+                self.logger.info("%s waited %.2fs for %d prefetched batches" %
+                                 (self.loader.name, self.wait_time, self.ptr))
+        return batch
+
+
+def _align(offset, size=8):
+    return (offset + size - 1) // size * size
+
+
+def _write_batch(batch, buf):
+    """
+    Copy the numeric arrays of a batch into the shared buffer buf.
+    :return: a list of (key, is_shared, value). value is (dtype, shape,
+    offset) for shared arrays and the value itself otherwise.
+    """
+    fields, offset = [], 0
+    for key, value in batch.items():
+        if isinstance(value, np.ndarray) and value.dtype != object:
+            value = np.ascontiguousarray(value)
+            end = offset + value.nbytes
+            if end <= len(buf):
+                buf[offset:end] = value.view(np.uint8).reshape(-1)
+                fields.append((key, True, (value.dtype.str, value.shape, offset)))
+                offset = _align(end)
+                continue
+        # strings, lists and arrays that do not fit go through the queue
+        fields.append((key, False, value))
+    return fields
+
+
+def _read_batch(fields, buf):
+    batch = Pack()
+    for key, is_shared, value in fields:
+        if is_shared:
+            dtype, shape, offset = value
+            dtype = np.dtype(dtype)
+            nbytes = int(np.prod(shape)) * dtype.itemsize
+            batch[key] = buf[offset:offset + nbytes].view(dtype).reshape(shape).copy()
+        else:
+            batch[key] = value
+    return batch
+
+
+def _pool_worker(loader, w_id, num_workers, start, num_batch, slots, free_q, out_q):
+    bufs = [np.frombuffer(slot, dtype=np.uint8) for slot in slots]
+    # the first batch of worker w is the first ptr >= start with ptr % num_workers == w
+    first = start + (w_id - start) % num_workers
+    try:
+        for ptr in range(first, num_batch, num_workers):
+            try:
+                batch = loader._get_batch(ptr)
+            except Exception:
+                out_q.put((ptr, None, traceback.format_exc()))
+                return
+            slot_id = free_q.get()
+            out_q.put((ptr, slot_id, _write_batch(batch, bufs[slot_id])))
+    except KeyboardInterrupt:
+        pass
+
+
+class WorkerPoolLoader(PrefetchLoader):
+    """
+    Build the batches of an epoch in num_workers processes. Worker w builds
+    the batches w, w + num_workers, ..., so reading the workers in turn
+    gives the batch order of the wrapped loader. The numeric arrays of a
+    batch are written into one of depth shared memory slots per worker and
+    only their dtype, shape and offset are pickled. Like PrefetchLoader,
+    epoch_init runs on the caller's side, the workers are forked afterwards
+    and see the epoch's batch_indexes, grid_indexes and warm up flags.
+
+    In a cached epoch of the wrapped loader the batches read from the
+    workers go into its cache, once it is complete no worker is started.
+
+    :ivar num_workers: the number of worker processes
+    :ivar slot_size: the bytes of one shared slot, batches that do not fit
+    send the remaining arrays through the queue
+    """
+
+    def __init__(self, loader, num_workers, depth=2):
+        super(WorkerPoolLoader, self).__init__(loader, depth)
+        self.num_workers = num_workers
+        self.slot_size = None
+        self._slots = None
+        self._bufs = None
+        self._procs = None
+        self._free_qs = None
+        self._out_qs = None
+
+    def _alloc_slots(self):
+        # size the slots after the largest of the first batches, with room to spare
+        sizes = [1 << 20]
+        for ptr in range(min(8, self.loader.num_batch)):
+            batch = self.loader._get_batch(ptr)
+            sizes.append(sum(_align(v.nbytes) for v in batch.values()
+                             if isinstance(v, np.ndarray) and v.dtype != object))
+        self.slot_size = 2 * max(sizes)
+        self._slots = [multiprocessing.RawArray('b', self.slot_size)
+                       for _ in range(self.num_workers * self.depth)]
+        self._bufs = [np.frombuffer(slot, dtype=np.uint8) for slot in self._slots]
+
+    def close(self):
+        """Stop the workers of the current epoch"""
+        if self._procs is None:
+            return
+        for proc in self._procs:
+            if proc.is_alive():
+                proc.terminate()
+            proc.join()
+        self._procs, self._free_qs, self._out_qs = None, None, None
+
+    def _start(self, ptr, verbose):
+        self.ptr = ptr
+        self.wait_time = 0.0
+        self._verbose = verbose
+        # nothing left to build, the batches come from the cache
+        self._direct = self.loader._cache_complete()
+        if self._direct:
+            return
+        if self._slots is None:
+            self._alloc_slots()
+
+        self._procs, self._free_qs, self._out_qs = [], [], []
+        for w_id in range(self.num_workers):
+            slot_ids = range(w_id * self.depth, (w_id + 1) * self.depth)
+            free_q, out_q = multiprocessing.Queue(), multiprocessing.Queue()
+            for slot_id in slot_ids:
+                free_q.put(slot_id)
+            proc = multiprocessing.Process(target=_pool_worker,
+                                           args=(self.loader, w_id, self.num_workers, ptr, self.loader.num_batch,
+                                                 self._slots, free_q, out_q))
+            proc.daemon = True
+            proc.start()
+            self._procs.append(proc)
+            self._free_qs.append(free_q)
+            self._out_qs.append(out_q)
+
+    def next_batch(self):
+        if self._direct:
+            return self._next_cached()
+        if self._procs is None or self.ptr >= self.loader.num_batch:
+            return None
+
+        w_id = self.ptr % self.num_workers
+        start = time.time()
+        try:
+            while True:
+                try:
+                    ptr, slot_id, fields = self._out_qs[w_id].get(timeout=0.1)
+                    break
+                except queue.Empty:
+                    if not self._procs[w_id].is_alive() and self._out_qs[w_id].empty():
+                        self.close()
+                        raise RuntimeError("%s batch worker %d died" % (self.loader.name, w_id))
+        except KeyboardInterrupt:
+            self.close()
+            raise
+        self.wait_time += time.time() - start
+
+        if slot_id is None:
+            self.close()
+            raise RuntimeError("%s batch worker %d failed on batch %d\n%s"
+                               % (self.loader.name, w_id, ptr, fields))
+        assert ptr == self.ptr
+        batch = _read_batch(fields, self._bufs[slot_id])
+        self._free_qs[w_id].put(slot_id)
+        if self.loader.batch_tensors:
+            batch = to_tensors(batch)
+        if self.loader.cached_epoch:
+            self.loader._batch_cache[1][ptr] = batch
+
+        self.ptr += 1
+        if self.ptr == self.loader.num_batch:
+            self.close()
+            if self._verbose:
+                self.logger.info("%s waited %.2fs for %d batches from %d workers" %
+                                 (self.loader.name, self.wait_time, self.ptr, self.num_workers))
+        return batch
+
+
+def prefetch(loader, config):
+    """
+    :return: the loader wrapped by a WorkerPoolLoader if config.batch_workers > 0,
+    by a PrefetchLoader if config.prefetch_depth > 0, otherwise the loader itself
+    """
+    if loader is None:
+        return loader
+    num_workers = getattr(config, 'batch_workers', 0)
+    depth = getattr(config, 'prefetch_depth', 0)
+    if num_workers > 0:
+        return WorkerPoolLoader(loader, num_workers, max(depth, 2))
+    if depth > 0:
+        return PrefetchLoader(loader, depth)
+    return loader
@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+
+import numpy as np
+import torch
+
+
+# the batch fields the models turn into tensors
+TENSOR_FIELDS = ('contexts', 'context_confs', 'outputs', 'output_actions', 'domain_metas')
+
+
+def to_tensors(batch):
+    """
+    Replace the numpy TENSOR_FIELDS of a batch by int64 or float32 torch
+    tensors. Arrays already in these dtypes are shared, not copied.
+    """
+    for key in TENSOR_FIELDS:
+        value = batch.get(key)
+        if isinstance(value, np.ndarray):
+            dtype = np.float32 if np.issubdtype(value.dtype, np.floating) else np.int64
+            batch[key] = torch.from_numpy(np.ascontiguousarray(value, dtype=dtype))
+    return batch
+
+
+class BatchBufferRing(object):
+    """
+    A ring of num_slots sets of torch buffers that the data loaders fill in
+    place instead of allocating new arrays per batch. Every buffer is flat
+    and only grows, so after the longest batches it has the worst case
+    size, and a batch field is a contiguous view of its first elements.
+    Integer fields are stored as int64 and float fields as float32, the
+    dtypes the models cast to, so np2var can use them without a copy.
+
+    A batch is only valid until the ring comes back to its slot, i.e. for
+    num_slots - 1 more batches.
+
+    :ivar num_slots: the number of batches whose buffers can be alive at once
+    :ivar pin_memory: allocate the buffers in page-locked memory for fast GPU copies
+    """
+
+    def __init__(self, num_slots, pin_memory=False):
+        self.num_slots = num_slots
+        self.pin_memory = pin_memory and torch.cuda.is_available()
+        self._slots = [dict() for _ in range(num_slots)]
+        self._cur = 0
+
+    def next_slot(self):
+        """Move to the buffers of the next batch"""
+        self._cur = (self._cur + 1) % self.num_slots
+
+    def get(self, name, shape, dtype, fill=None):
+        """
+        :param dtype: the numpy dtype the loader would have used
+        :param fill: if not None, set every element of the view to it
+        :return: (tensor, array), a torch view of the shape and a numpy
+        array sharing its memory for the loader to write into
+        """
+        t_dtype = torch.float32 if np.issubdtype(dtype, np.floating) else torch.int64
+        numel = int(np.prod(shape))
+        buf = self._slots[self._cur].get(name)
+        if buf is None or buf.numel() < numel or buf.dtype != t_dtype:
+            buf = torch.empty(numel, dtype=t_dtype)
+            if self.pin_memory:
+                buf = buf.pin_memory()
+            self._slots[self._cur][name] = buf
+        tensor = buf[0:numel].view(*shape)
+        if fill is not None:
+            tensor.fill_(fill)
+        return tensor, tensor.numpy()
+
+
+def make_buffer_ring(config):
+    """
+    :return: a BatchBufferRing if config.batch_buffers, otherwise None. It
+    has room for the prefetched batches plus the ones in use and is off
+    with batch_workers, whose batches go through shared memory instead.
+    """
+    if not getattr(config, 'batch_buffers', False) or getattr(config, 'batch_workers', 0) > 0:
+        return None
+    return BatchBufferRing(getattr(config, 'prefetch_depth', 0) + 3,
+                           pin_memory=getattr(config, 'pin_batches', False))
@@ -0,0 +1,279 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+
+import logging
+import sys
+
+import numpy as np
+
+from zsdg.utils import Pack
+from zsdg.dataset.corpus_cache import dialogs_to_arrays
+
+
+def pack_nbytes(obj, seen=None):
+    """
+    Estimate the memory held by a nest of Packs, lists and scalars
+    :param obj: e.g. a list of list of turn Packs
+    :return: the number of bytes, objects shared several times are counted once
+    """
+    if seen is None:
+        seen = set()
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(pack_nbytes(k, seen) + pack_nbytes(v, seen) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple)):
+        size += sum(pack_nbytes(v, seen) for v in obj)
+    return size
+
+
+class TurnView(object):
+    """
+    A read-only turn backed by the arrays of a CompactDialogCorpus. It
+    answers the same attribute and get() calls as the turn Pack, and
+    copy() materializes a real Pack.
+    """
+    __slots__ = ('_corpus', '_t_id')
+
+    def __init__(self, corpus, t_id):
+        self._corpus = corpus
+        self._t_id = t_id
+
+    def __getattr__(self, name):
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name)
+
+    def __getitem__(self, key):
+        return self._corpus.turn_field(self._t_id, key)
+
+    def __contains__(self, key):
+        return key in self.keys()
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def keys(self):
+        return self._corpus.turn_keys(self._t_id)
+
+    def items(self):
+        return [(k, self[k]) for k in self.keys()]
+
+    def copy(self):
+        return Pack(self.items())
+
+
+class DialogView(object):
+    """A dialog of a CompactDialogCorpus, indexing gives TurnViews"""
+    __slots__ = ('_corpus', '_start', '_end')
+
+    def __init__(self, corpus, start, end):
+        self._corpus = corpus
+        self._start = start
+        self._end = end
+
+    def __len__(self):
+        return self._end - self._start
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [TurnView(self._corpus, self._start + i) for i in range(*idx.indices(len(self)))]
+        if idx < 0:
+            idx += len(self)
+        if idx < 0 or idx >= len(self):
+            raise IndexError(idx)
+        return TurnView(self._corpus, self._start + idx)
+
+    def __iter__(self):
+        for t_id in range(self._start, self._end):
+            yield TurnView(self._corpus, t_id)
+
+
+class CompactDialogCorpus(object):
+    """
+    A columnar corpus of id'd dialogs. All tokens live in one flat int32
+    buffer with utterance offsets, dialogs are offsets into the utterance
+    table and speaker, domain, domain_id, kb_id and conf are parallel
+    arrays (the layout of dialogs_to_arrays). Indexing returns thin views
+    that the data loaders consume like the list of list of turn Packs.
+
+    :ivar arrays: the dict of column arrays, possibly memory-mapped
+    :ivar meta: the speaker and domain tables
+    :ivar dialog_ids: the dialogs of the full table that this corpus selects
+    """
+    logger = logging.getLogger()
+
+    def __init__(self, arrays, meta, dialog_ids=None):
+        self.arrays = arrays
+        self.meta = meta
+        num_dialog = len(arrays['dialog_offsets']) - 1
+        if dialog_ids is None:
+            dialog_ids = np.arange(num_dialog, dtype=np.int64)
+        self.dialog_ids = np.asarray(dialog_ids, dtype=np.int64)
+
+        # plain lists make per turn access cheap, the token buffers stay numpy
+        self._dialog_offsets = arrays['dialog_offsets'].tolist()
+        self._utt_offsets = arrays['utt_offsets'].tolist()
+        self._speaker = arrays['speaker'].tolist()
+        self._domain = arrays['domain'].tolist()
+        self._has_actions = arrays['has_actions'].tolist()
+        self._has_state = arrays['has_state'].tolist()
+
+    @classmethod
+    def from_dialogs(cls, dialogs, name=None):
+        """
+        :param dialogs: a list of list of id'd turn Packs
+        :param name: if given, log the footprint against the Pack corpus
+        """
+        arrays, meta = dialogs_to_arrays(dialogs)
+        corpus = cls(arrays, meta)
+        if name is not None:
+            cls.logger.info("{} corpus takes {:.2f}MB compact vs {:.2f}MB as Packs".format(
+                name, corpus.nbytes() / 1e6, pack_nbytes(dialogs) / 1e6))
+        return corpus
+
+    def nbytes(self):
+        return int(sum(a.nbytes for a in self.arrays.values())) + self.dialog_ids.nbytes
+
+    def to_arrays(self):
+        """
+        :return: (arrays, meta) in the dialogs_to_arrays format
+        """
+        if len(self.dialog_ids) == len(self._dialog_offsets) - 1 \
+                and np.all(self.dialog_ids == np.arange(len(self.dialog_ids))):
+            return self.arrays, self.meta
+        return dialogs_to_arrays(list(self))
+
+    def select(self, ids):
+        """
+        :return: a new corpus of the given dialogs that shares the buffers
+        """
+        return CompactDialogCorpus(self.arrays, self.meta, self.dialog_ids[np.asarray(ids, dtype=np.int64)])
+
+    def __len__(self):
+        return len(self.dialog_ids)
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return self.select(np.arange(len(self))[idx])
+        d_id = int(self.dialog_ids[idx])
+        return DialogView(self, self._dialog_offsets[d_id], self._dialog_offsets[d_id+1])
+
+    def __iter__(self):
+        for idx in range(len(self)):
+            yield self[idx]
+
+    def _rows(self, data_key, offset_key, s, e):
+        data, offsets = self.arrays[data_key], self.arrays[offset_key]
+        return [data[offsets[i]:offsets[i+1]].tolist() for i in range(s, e)]
+
+    def turn_keys(self, t_id):
+        keys = ['utt', 'speaker']
+        if self.meta['has_conf']:
+            keys.append('conf')
+        if self.meta['domains'][self._domain[t_id]] is not None:
+            keys.append('domain')
+        if self.meta['has_domain_id']:
+            keys.extend(['domain_id', 'meta'])
+        if self.meta['has_kb_id']:
+            keys.append('kb_id')
+        if self._has_actions[t_id]:
+            keys.append('actions')
+        if self._has_state[t_id]:
+            keys.append('state')
+        return keys
+
+    def turn_field(self, t_id, key):
+        """
+        :return: the value the turn Pack holds under key, raise KeyError if absent
+        """
+        a = self.arrays
+        if key == 'utt':
+            return a['utt'][self._utt_offsets[t_id]:self._utt_offsets[t_id+1]].tolist()
+        elif key == 'speaker':
+            return self.meta['speakers'][self._speaker[t_id]]
+        elif key == 'conf' and self.meta['has_conf']:
+            return float(a['conf'][t_id])
+        elif key == 'domain' and self.meta['domains'][self._domain[t_id]] is not None:
+            return self.meta['domains'][self._domain[t_id]]
+        elif key == 'domain_id' and self.meta['has_domain_id']:
+            return int(a['domain_id'][t_id])
+        elif key == 'meta' and self.meta['has_domain_id']:
+            return None
+        elif key == 'kb_id' and self.meta['has_kb_id']:
+            return int(a['kb_id'][t_id])
+        elif key == 'actions' and self._has_actions[t_id]:
+            offsets = a['actions_offsets']
+            return a['actions'][offsets[t_id]:offsets[t_id+1]].tolist()
+        elif key == 'state' and self._has_state[t_id]:
+            s, e = a['state_offsets'][t_id], a['state_offsets'][t_id+1]
+            return [Pack(cat=cat, real=real) for cat, real in
+                    zip(self._rows('state_cat', 'state_cat_offsets', s, e), a['state_real'][s:e].tolist())]
+        raise KeyError(key)
+
+
+def select_dialogs(data, ids):
+    """
+    Pick dialogs by index from either a CompactDialogCorpus or a list
+    """
+    if isinstance(data, CompactDialogCorpus):
+        return data.select(ids)
+    return [data[i] for i in ids]
+
+
+def corpus_to_arrays(data):
+    """
+    :return: (arrays, meta) of either a CompactDialogCorpus or a list of dialogs
+    """
+    if isinstance(data, CompactDialogCorpus):
+        return data.to_arrays()
+    return dialogs_to_arrays(data)
+
+
+class KBTable(object):
+    """
+    The KB tables of a corpus, stored once per dialog instead of once per
+    turn. The rows of all tables are padded to the same length and stacked
+    into one int32 matrix, a table id selects a slice of rows.
+
+    :ivar rows: a [num_rows, max_len] int32 matrix
+    :ivar offsets: table i is rows[offsets[i]:offsets[i+1]]
+    """
+
+    def __init__(self, rows, offsets):
+        self.rows = rows
+        self.offsets = offsets
+        self._offsets = offsets.tolist()
+
+    @classmethod
+    def from_matrices(cls, matrices, max_len):
+        """
+        :param matrices: a list of [num_rows, max_len] int32 matrices
+        """
+        offsets = np.zeros(len(matrices) + 1, dtype=np.int64)
+        offsets[1:] = np.cumsum([len(m) for m in matrices])
+        if matrices:
+            rows = np.concatenate(matrices).astype(np.int32)
+        else:
+            rows = np.zeros((0, max_len), dtype=np.int32)
+        return cls(rows, offsets)
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def __getitem__(self, kb_id):
+        """
+        :return: the rows of the table kb_id, no rows for a negative id
+        """
+        if kb_id < 0:
+            return self.rows[0:0]
+        return self.rows[self._offsets[kb_id]:self._offsets[kb_id+1]]
+
+    def nbytes(self):
+        return self.rows.nbytes + self.offsets.nbytes
@@ -3,14 +3,22 @@
 from __future__ import unicode_literals  # at top of module
 
 from collections import Counter
+import bisect
+import heapq
 import json
 import logging
 import os
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
+from functools import partial
 
 import numpy as np
 
-from zsdg.utils import get_tokenize, get_chat_tokenize, missingdict, Pack
+from zsdg.utils import get_tokenize, get_chat_tokenize, Pack, iter_json_items
+from zsdg.utils import get_worker_pool, parallel_map
+from zsdg.dataset.corpus_cache import CorpusCache, ShardCache, arrays_to_dialogs, to_pack
+from zsdg.dataset.corpus_cache import save_session_corpus, load_session_corpus
+from zsdg.dataset.vocabulary import Vocabulary
+from zsdg.dataset.compact_corpus import CompactDialogCorpus, KBTable, select_dialogs, corpus_to_arrays
 
 PAD = '<pad>'
 UNK = '<unk>'
@@ -31,9 +39,78 @@ INF = "<informable>"
 WILD = "%s"
 
 
+def _norm_simdial_dialog(raw_dialog, include_domain):
+    tokenize = get_tokenize()
+    norm_dialog = [Pack(speaker=USR, conf=1.0, utt= [BOS, raw_dialog[0]['domain'], BOD, EOS])]
+    for l in raw_dialog:
+        msg = Pack.msg_from_dict(l, tokenize,
+                                 {"SYS": SYS, "USR": USR},
+                                 BOS, EOS, include_domain=include_domain)
+        norm_dialog.append(msg)
+    return norm_dialog
+
+
+def _norm_smd_dialog(raw_dialog, include_domain):
+    tokenize = get_tokenize()
+    speaker_map = {'assistant': SYS, 'driver': USR}
+    domain = raw_dialog['scenario']['task']['intent']
+    kb_items = []
+    if raw_dialog['scenario']['kb']['items'] is not None:
+        for item in raw_dialog['scenario']['kb']['items']:
+            kb_items.append([KB]+tokenize(" ".join(["{} {}".format(k, v) for k, v in item.items()])))
+
+    dialog = [Pack(utt=[BOS, domain, BOD, EOS], speaker=USR, slots=None, domain=domain)]
+    for turn in raw_dialog['dialogue']:
+        utt = turn['data']['utterance']
+        slots = turn['data'].get('slots')
+        speaker = speaker_map[turn['turn']]
+        if include_domain:
+            utt = [BOS, speaker, domain] + tokenize(utt) + [EOS]
+        else:
+            utt = [BOS, speaker] + tokenize(utt) + [EOS]
+
+        if speaker == SYS:
+            dialog.append(Pack(utt=utt, speaker=speaker, slots=slots, domain=domain, kb=kb_items))
+        else:
+            dialog.append(Pack(utt=utt, speaker=speaker, slots=slots, domain=domain, kb=[]))
+    return dialog
+
+
+def _norm_smd_seed(line, include_domain):
+    tokenize = get_tokenize()
+    speaker_map = {'assistant': SYS, 'driver': USR}
+    domain, tokens = line
+    utt = tokens[1]
+    speaker = tokens[0]
+    action = tokens[3]
+    if include_domain:
+        utt = [BOS, speaker_map[speaker], domain] + tokenize(utt) + [EOS]
+        action = [BOS, speaker_map[speaker], domain] + tokenize(action) + [EOS]
+    else:
+        utt = [BOS, speaker_map[speaker]] + tokenize(utt) + [EOS]
+        action = [BOS, speaker_map[speaker]] + tokenize(action) + [EOS]
+    return Pack(domain=domain, speaker=speaker, utt=utt, actions=action)
+
+
+def _freeze(obj):
+    """
+    A hashable key of a JSON value. Values are tagged with their type, so
+    1 and "1" differ, and dicts keep their order since _act_to_str follows it.
+    """
+    if isinstance(obj, dict):
+        return 'dict', tuple((k, _freeze(v)) for k, v in obj.items())
+    elif type(obj) is list:
+        return 'list', tuple(_freeze(v) for v in obj)
+    return type(obj).__name__, obj
+
+
 class SimDialCorpus(object):
 
-    def __init__(self, config, max_vocab_size=10000):
+    def __init__(self, config, max_vocab_size=10000, session_dir=None):
+        """
+        :param session_dir: a trained session to evaluate. If it has a saved
+        corpus, only the test split is read with the saved vocabulary.
+        """
         self.config = config
         self.max_utt_len = config.max_utt_len
         self.black_domains = config.black_domains
@@ -42,48 +119,228 @@ class SimDialCorpus(object):
         self.include_example = config.include_example
         self.include_state = config.include_state
         self.tokenize = get_tokenize()
-
-        train_data, train_meta = self._read_file(self.config.train_dir, is_train=True)
-        test_data, test_meta = self._read_file(self.config.test_dir, is_train=False)
+        self.compact = getattr(config, 'compact_corpus', False)
+        self.corpus, self.test_corpus = None, None
+        self._pool = None
+        # (domain, name, expected, value, max_val, include_example) -> id list
+        self._id_slot_cache = {}
+        self._id_slot_hits, self._id_slot_misses = 0, 0
+        # (speaker, act key) -> act tokens, (speaker, act keys) -> action ids
+        self._act_tokens_cache = {}
+        self._act_ids_cache = {}
+
+        session = load_session_corpus(session_dir) if session_dir is not None else None
+        if session is not None:
+            self._load_test_split(*session)
+            self._build_seed_index()
+            logging.info("Done loading corpus")
+            return
+
+        cache = self._get_cache(max_vocab_size)
+        if cache is not None and cache.exists():
+            self._load_cache(cache)
+            self._build_seed_index()
+            logging.info("Done loading corpus")
+            return
+
+        train_meta, test_meta = {}, {}
+        self._pool = get_worker_pool(getattr(config, 'preprocess_workers', 1))
+        try:
+            self.corpus, train_counts = self._read_split(self.config.train_dir, train_meta, is_train=True)
+            self.test_corpus, test_counts = self._read_split(self.config.test_dir, test_meta, is_train=False)
+        finally:
+            if self._pool is not None:
+                self._pool.terminate()
+            self._pool = None
 
         # combine train and test domain meta
         train_meta.update(test_meta)
         self.domain_meta = self._process_meta(train_meta)
-        self.corpus = self._process_dialog(train_data)
-        self.test_corpus = self._process_dialog(test_data)
         logging.info("Loaded Corpus with %d, test %d"
                          % (len(self.corpus), len(self.test_corpus)))
 
         # build up a vocabulary
-        self.vocab, self.rev_vocab = self._build_vocab(max_vocab_size)
-
+        self.vocab, self.rev_vocab = self._build_vocab(max_vocab_size, train_counts, test_counts)
+
+        # convert to IDs once, the splits and seed responses are selected from these
+        self.id_corpus = self._to_id_corpus('Corpus', self.corpus)
+        self.id_test_corpus = self._to_id_corpus('Test', self.test_corpus)
+        logging.info(self.tokenize.summary())
+        if self.compact:
+            self.id_corpus = CompactDialogCorpus.from_dialogs(self.id_corpus, 'Train')
+            self.id_test_corpus = CompactDialogCorpus.from_dialogs(self.id_test_corpus, 'Test')
+        self.turn_corpus = [Pack(utt=msg.utt, actions=msg.get('actions'), domain=msg.domain, speaker=msg.speaker)
+                            for dialog in self.corpus + self.test_corpus for msg in dialog[1:]]
+        if cache is not None:
+            self._save_cache(cache)
+
+        self._build_seed_index()
         logging.info("Done loading corpus")
 
-    def _read_file(self, paths, is_train):
+    def save_session(self, session_dir):
         """
-        Read data from file
+        Save the vocabulary, the domain meta and the turns the evaluator
+        learns from, which is all a forward_only run needs from training.
+        """
+        # TurnEvaluator only looks at the first 1000 system turns per domain
+        domain_cnt = Counter()
+        eval_turns = []
+        for msg in self.get_turn_corpus(SYS):
+            domain_cnt[msg.domain] += 1
+            if domain_cnt[msg.domain] <= 1000:
+                eval_turns.append(Pack(msg, speaker=SYS))
+        save_session_corpus(session_dir, self.vocab.to_array(),
+                            {'domain_meta': self.domain_meta, 'turn_corpus': eval_turns})
+
+    def _load_test_split(self, vocab, meta):
+        """
+        Read the test split only, with the vocabulary and domain meta of
+        the saved session. There is no train data, so no seed responses.
+        """
+        self.vocab = Vocabulary(vocab, unk=UNK, pad=PAD)
+        self.rev_vocab = self.vocab.rev_vocab
+        self.domain_meta = to_pack(meta['domain_meta'])
+        self.turn_corpus = to_pack(meta['turn_corpus'])
+
+        self._pool = get_worker_pool(getattr(self.config, 'preprocess_workers', 1))
+        try:
+            self.test_corpus, _ = self._read_split(self.config.test_dir, {}, is_train=False)
+        finally:
+            if self._pool is not None:
+                self._pool.terminate()
+            self._pool = None
+        self.corpus = []
+        self.id_corpus = []
+        self.id_test_corpus = self._to_id_corpus('Test', self.test_corpus)
+        if self.compact:
+            self.id_test_corpus = CompactDialogCorpus.from_dialogs(self.id_test_corpus, 'Test')
+        logging.info("Loaded test split with %d dialogs" % len(self.id_test_corpus))
+
+    def _get_cache(self, max_vocab_size):
+        if not getattr(self.config, 'use_cache', False):
+            return None
+        paths = [p for ps in [self.config.train_dir, self.config.test_dir]
+                 for p in (ps if type(ps) is list else [ps])]
+        settings = {'max_utt_len': self.max_utt_len,
+                    'include_domain': self.include_domain,
+                    'include_state': self.include_state,
+                    'include_example': self.include_example,
+                    'data_cap': self.config.data_cap,
+                    'max_vocab_size': max_vocab_size}
+        return CorpusCache(self.config.cache_dir, 'simdial', paths, settings)
+
+    def _get_shard_cache(self, is_train):
+        if not getattr(self.config, 'use_cache', False):
+            return None
+        settings = {'include_domain': self.include_domain,
+                    'data_cap': self.config.data_cap if is_train else None}
+        return ShardCache(self.config.cache_dir, 'simdial', settings)
+
+    def _read_split(self, paths, metas, is_train):
+        """
+        Read every file of a split through its own shard, only files that
+        are new or changed are tokenized again.
         :param paths: a list of path or a string path
-        :return: a list of dialogs
+        :param metas: a dict that is filled with domain name -> meta
+        :return: (dialogs, counts). counts holds the merged Counters words
+        (utterances and acts in reading order), utts and acts.
         """
-        dialogs = []
-        metas = {}
         if type(paths) is not list:
             paths = [paths]
+        shard_cache = self._get_shard_cache(is_train)
+        dialogs = []
+        counts = Pack(words=Counter(), utts=Counter(), acts=Counter())
         for path in paths:
-            data = json.load(open(path, 'rb'))
-            meta = data['meta']
-            conversations = data['dialogs']
-            metas[meta['name']] = meta
+            shard = shard_cache.load(path) if shard_cache is not None else None
+            if shard is None:
+                shard = self._build_shard(path, is_train)
+                if shard_cache is not None:
+                    shard_cache.save(path, shard)
+            else:
+                # turns are Packs, their actions and state stay plain JSON
+                shard['dialogs'] = [[Pack(msg) for msg in dialog] for dialog in shard['dialogs']]
+                logging.info("Reuse {} dialogs of {}".format(len(shard['dialogs']), path))
 
-            if is_train and self.config.data_cap is not None \
-                    and self.config.data_cap < len(conversations):
-                data_size = min(self.config.data_cap, len(conversations))
-                logging.info("Capped {} data to {}".format(path, data_size))
-                conversations = conversations[0:data_size]
+            metas.update(shard['metas'])
+            dialogs.extend(shard['dialogs'])
+            for key in ['words', 'utts', 'acts']:
+                for word, cnt in shard[key]:
+                    counts[key][word] += cnt
 
-            dialogs.extend(conversations)
+        self._log_dialog_stats(dialogs)
+        return dialogs, counts
 
-        return dialogs, metas
+    def _build_shard(self, path, is_train):
+        """
+        :return: a JSON friendly dict of the metas, the tokenized dialogs
+        and the token counts of one file
+        """
+        metas = {}
+        dialogs = self._process_dialog(self._read_file(path, metas, is_train))
+        words, utts, acts = Counter(), Counter(), Counter()
+        for dialog in dialogs:
+            for msg in dialog:
+                words.update(msg.utt)
+                utts.update(msg.utt)
+                if 'actions' in msg:
+                    for act in msg.actions:
+                        tokens = self._act_tokens(msg.speaker, act)
+                        words.update(tokens)
+                        acts.update(tokens)
+
+        # counts are lists of pairs to keep the order of first appearance
+        return {'metas': metas, 'dialogs': dialogs,
+                'words': list(words.items()),
+                'utts': list(utts.items()),
+                'acts': list(acts.items())}
+
+    def _save_cache(self, cache):
+        train_arrays, train_tables = corpus_to_arrays(self.id_corpus)
+        test_arrays, test_tables = corpus_to_arrays(self.id_test_corpus)
+        arrays = CorpusCache.prefix(train_arrays, 'train')
+        arrays.update(CorpusCache.prefix(test_arrays, 'test'))
+        arrays['vocab'] = self.vocab.to_array()
+        meta = {'train': train_tables, 'test': test_tables,
+                'domain_meta': self.domain_meta,
+                'turn_corpus': self.turn_corpus}
+        cache.save(arrays, meta)
+
+    def _load_cache(self, cache):
+        arrays, meta = cache.load()
+        self.vocab = Vocabulary(arrays['vocab'].tolist(), unk=UNK, pad=PAD)
+        self.rev_vocab = self.vocab.rev_vocab
+        self.domain_meta = to_pack(meta['domain_meta'])
+        self.turn_corpus = to_pack(meta['turn_corpus'])
+        # only the compact corpus keeps the memory-mapped arrays, shared between processes
+        load_func = CompactDialogCorpus if self.compact else arrays_to_dialogs
+        self.id_corpus = load_func(CorpusCache.unprefix(arrays, 'train'), meta['train'])
+        self.id_test_corpus = load_func(CorpusCache.unprefix(arrays, 'test'), meta['test'])
+        logging.info("Loaded Corpus with %d, test %d"
+                     % (len(self.id_corpus), len(self.id_test_corpus)))
+
+    def _read_file(self, paths, metas, is_train):
+        """
+        Stream dialogs from file one at a time, so the raw JSON of a whole
+        file is never resident at once.
+        :param paths: a list of path or a string path
+        :param metas: a dict that is filled with domain name -> meta
+        :return: a generator of dialogs
+        """
+        if type(paths) is not list:
+            paths = [paths]
+        for path in paths:
+            data_cap = self.config.data_cap if is_train else None
+            dialog_cnt = 0
+            for key, value in iter_json_items(path, 'dialogs'):
+                if key == 'meta':
+                    metas[value['name']] = value
+                elif key == 'dialogs':
+                    dialog_cnt += 1
+                    if data_cap is None or dialog_cnt <= data_cap:
+                        yield value
+
+            if data_cap is not None and data_cap < dialog_cnt:
+                logging.info("Capped {} data to {}".format(path, data_cap))
 
     def _dict_to_str(self, name, data, keys=None):
         if keys is None:
@@ -168,22 +425,16 @@ class SimDialCorpus(object):
         For the return dialog corpus, each uttearnce is is represented by:
         (speaker, conf, utterance)
         
-        :param data: a list of list of utterances 
+        :param data: an iterable of list of utterances
         :return: a dialog coprus. 
         """
-        dialogs = []
-        all_length = []
-        all_dialog_len = []
-        for raw_dialog in data:
-            norm_dialog = [Pack(speaker=USR, conf=1.0, utt= [BOS, raw_dialog[0]['domain'], BOD, EOS])]
-            for l in raw_dialog:
-                msg = Pack.msg_from_dict(l, self.tokenize,
-                                         {"SYS": SYS, "USR": USR},
-                                         BOS, EOS, include_domain=self.include_domain)
-                norm_dialog.append(msg)
-                all_length.append(len(msg.utt))
-            dialogs.append(norm_dialog)
-            all_dialog_len.append(len(norm_dialog))
+        norm_func = partial(_norm_simdial_dialog, include_domain=self.include_domain)
+        workers = getattr(self.config, 'preprocess_workers', 1)
+        return list(parallel_map(norm_func, data, self._pool, workers))
+
+    def _log_dialog_stats(self, dialogs):
+        all_length = [len(msg.utt) for dialog in dialogs for msg in dialog[1:]]
+        all_dialog_len = [len(dialog) for dialog in dialogs]
 
         max_len = np.max(all_length)
         mean_len = float(np.average(all_length))
@@ -192,57 +443,47 @@ class SimDialCorpus(object):
                          (max_len, mean_len, self.max_utt_len, coverage))
         logging.info("Max dialog len %d, mean dialog len %.2f" %
                          (np.max(all_dialog_len), np.average(all_dialog_len)))
-        return dialogs
 
-    def _build_vocab(self, max_vocab_cnt, speaker=None):
-        all_words = []
-        for dialogs in self.corpus:
-            for msg in dialogs:
-                if speaker is None or speaker == msg.speaker:
-                    all_words.extend(msg.utt)
-                    if 'actions' in msg:
-                        for act in msg.actions:
-                            all_words.extend(self._act_to_str(msg.speaker, act))
-
-        all_test_words = []
-        for dialogs in self.test_corpus:
-            for msg in dialogs:
-                if speaker is None or speaker == msg.speaker:
-                    all_test_words.extend(msg.utt)
-                    if 'actions' in msg:
-                        for act in msg.actions:
-                            temp = self._act_to_str(msg.speaker, act)
-                            all_words.extend(temp)
+    def _build_vocab(self, max_vocab_cnt, train_counts, test_counts):
+        """
+        Merge the token counts of the shards with the domain meta words.
+        :param train_counts: the counts of the train split from _read_split
+        :param test_counts: the counts of the test split from _read_split
+        """
+        # the test acts count as training words, as the test utterances do not
+        word_counts = Counter()
+        word_counts.update(train_counts.words)
+        word_counts.update(test_counts.acts)
 
+        meta_words = []
         for key, domain in self.domain_meta.items():
-            all_words.append(key)
-            all_words.extend(domain.usr_id2slot)
-            all_words.extend(domain.sys_id2slot)
+            meta_words.append(key)
+            meta_words.extend(domain.usr_id2slot)
+            meta_words.extend(domain.sys_id2slot)
             for slot, slot_meta in domain.items():
                 if "#" not in slot:
                     continue
                 for example in slot_meta:
-                    all_words.extend(example.utt)
+                    meta_words.extend(example.utt)
+        word_counts.update(meta_words)
+        num_words = sum(word_counts.values())
 
-        vocab_count = Counter(all_words+all_test_words).most_common()
+        word_counts.update(test_counts.utts)
+        vocab_count = word_counts.most_common()
         raw_vocab_size = len(vocab_count)
         discard_wc = np.sum([c for t, c, in vocab_count[max_vocab_cnt:]])
         vocab_count = vocab_count[0:max_vocab_cnt]
 
         # create vocabulary list sorted by count
-        speaker_str = "both" if speaker is None else speaker
-        logging.info("Raw vocab %d, vocab size %d, cut_off %d, train UNK rate %.4f For %s speaker"
+        logging.info("Raw vocab %d, vocab size %d, cut_off %d, train UNK rate %.4f For both speaker"
                          % (raw_vocab_size, len(vocab_count), vocab_count[-1][1],
-                            float(discard_wc) / len(all_words), speaker_str))
+                            float(discard_wc) / num_words))
 
-        vocab = [PAD, UNK, SEP, REQ, INF] + [t for t, cnt in vocab_count]
-        rev_vocab = missingdict(lambda: vocab.index(UNK))
-        for idx, word in enumerate(vocab):
-            rev_vocab[word] = idx
+        vocab = Vocabulary([PAD, UNK, SEP, REQ, INF] + [t for t, cnt in vocab_count], unk=UNK, pad=PAD)
+        rev_vocab = vocab.rev_vocab
 
-        test_vocab_count = Counter(all_test_words).most_common()
-        test_unk_cnt = np.sum([c for t, c in test_vocab_count if rev_vocab[t] == vocab.index(UNK)])
-        unk_ratio = float(test_unk_cnt) / len(all_test_words)
+        test_unk_cnt = np.sum([c for t, c in test_counts.utts.items() if rev_vocab[t] == vocab.unk_id])
+        unk_ratio = float(test_unk_cnt) / sum(test_counts.utts.values())
         logging.info("Test vocabulary UNK rate %.4f" % (unk_ratio))
 
         return vocab, rev_vocab
@@ -272,22 +513,38 @@ class SimDialCorpus(object):
         str_paras = map(str, str_paras)
         return [intent] + str_paras
 
-    def _to_id_corpus(self, name, data, use_black_list):
+    def _act_tokens(self, speaker, act):
+        key = (speaker, _freeze(act))
+        tokens = self._act_tokens_cache.get(key)
+        if tokens is None:
+            tokens = self._act_to_str(speaker, act)
+            self._act_tokens_cache[key] = tokens
+        return tokens
+
+    def _act_ids(self, speaker, actions):
+        """
+        :return: the interned word ids of all actions of a message
+        """
+        key = (speaker, tuple(_freeze(act) for act in actions))
+        tkn_acts = self._act_ids_cache.get(key)
+        if tkn_acts is None:
+            str_acts = []
+            for act in actions:
+                str_acts.append(' '.join(self._act_tokens(speaker, act)))
+
+            str_acts = self.tokenize("|".join(str_acts))
+            str_acts = [speaker] + str_acts
+            tkn_acts = tuple(self.rev_vocab[t] for t in str_acts)
+            self._act_ids_cache[key] = tkn_acts
+        return tkn_acts
+
+    def _to_id_corpus(self, name, data):
         results = []
-        kick_cnt = 0
         for dialog in data:
             temp = []
-            is_kicked = False
-            should_filter = np.random.rand() < self.black_ratio
             # convert utterance and feature into numeric numbers
             for msg in dialog:
                 domain = msg.get("domain")
-                if use_black_list and self.black_domains \
-                        and domain in self.black_domains \
-                        and should_filter:
-                    is_kicked = True
-                    break
-
                 copy_msg = msg.copy()
                 copy_msg['utt'] = [self.rev_vocab[t] for t in msg.utt]
 
@@ -317,33 +574,55 @@ class SimDialCorpus(object):
 
                 # make action become Ids
                 if 'actions' in copy_msg.keys():
-                    str_acts = []
-                    for act in msg.actions:
-                        tokens = self._act_to_str(msg.speaker, act)
-                        str_acts.append(' '.join(tokens))
-
-                    str_acts = self.tokenize("|".join(str_acts))
-
-                    if self.include_domain and False:
-                        str_acts = [msg.speaker, domain] + str_acts
-                    else:
-                        str_acts = [msg.speaker] + str_acts
-
-                    tkn_acts = [self.rev_vocab[t] for t in str_acts]
-
-                    copy_msg['actions'] = tkn_acts
+                    copy_msg['actions'] = list(self._act_ids(msg.speaker, msg.actions))
 
                 temp.append(copy_msg)
+            results.append(temp)
+        logging.info("Converted {} dialogs from {}".format(len(results), name))
+        if self.include_state:
+            logging.info("Slot id cache {} hits, {} misses".format(self._id_slot_hits, self._id_slot_misses))
+        logging.info("{} distinct acts, {} distinct action lists".format(
+            len(self._act_tokens_cache), len(self._act_ids_cache)))
+        return results
 
-            if not is_kicked:
-                results.append(temp)
-            else:
+    def _filter_black_list(self, name, data, use_black_list):
+        keep_ids = []
+        kick_cnt = 0
+        for d_id, dialog in enumerate(data):
+            domain = dialog[1].get("domain") if len(dialog) > 1 else None
+            should_filter = np.random.rand() < self.black_ratio
+            if use_black_list and self.black_domains \
+                    and domain in self.black_domains \
+                    and should_filter:
                 kick_cnt += 1
+            else:
+                keep_ids.append(d_id)
         logging.info("Filter {} samples from {}".format(kick_cnt, name))
 
-        return results
+        return select_dialogs(data, keep_ids)
 
     def _get_id_slot(self, slot, domain):
+        """
+        The id list of a slot is the same every time the slot shows up, so
+        it is computed once and the cached list is shared by all turns.
+        """
+        key = (domain, slot.get('name'), slot.get('expected'), slot.get('value'),
+               slot.get('max_val'), self.include_example)
+        try:
+            id_cat = self._id_slot_cache.get(key)
+        except TypeError:
+            # unhashable slot values are rare, just compute them
+            return self._compute_id_slot(slot, domain)
+
+        if id_cat is None:
+            self._id_slot_misses += 1
+            id_cat = self._compute_id_slot(slot, domain)
+            self._id_slot_cache[key] = id_cat
+        else:
+            self._id_slot_hits += 1
+        return id_cat
+
+    def _compute_id_slot(self, slot, domain):
         def tokenize(t):
             if t is None:
                 return [UNK]
@@ -383,24 +662,22 @@ class SimDialCorpus(object):
         :return: {train: [d1, d2, ...], valid: [d1, d2, ...], test: [d1, d2, ...]} 
         """
         # get equal amount of valid data from each domains
-        id2domains = defaultdict(list)
-        for d_id, d in enumerate(self.corpus):
-            id2domains[d[1].domain].append(d_id)
-        domain_valid_size = int(min(1000, int(len(self.corpus) * 0.1))/len(id2domains))
+        id2domains = self._domain_dialogs
+        domain_valid_size = int(min(1000, int(len(self.id_corpus) * 0.1))/max(len(id2domains), 1))
         train_ids, valid_ids = [], []
         for ids in id2domains.values():
             train_ids.extend(ids[domain_valid_size:])
             valid_ids.extend(ids[0:domain_valid_size])
 
         logging.info("Loaded Corpus with train %d, valid %d, test %d"
-                         % (len(train_ids), len(valid_ids), len(self.test_corpus)))
+                         % (len(train_ids), len(valid_ids), len(self.id_test_corpus)))
 
-        train_corpus = [self.corpus[i] for i in train_ids]
-        valid_corpus = [self.corpus[i] for i in valid_ids]
+        train_corpus = select_dialogs(self.id_corpus, train_ids)
+        valid_corpus = select_dialogs(self.id_corpus, valid_ids)
 
-        id_train = self._to_id_corpus('train', train_corpus, use_black_list=True)
-        id_valid = self._to_id_corpus('valid', valid_corpus, use_black_list=True)
-        id_test = self._to_id_corpus('test', self.test_corpus, use_black_list=False)
+        id_train = self._filter_black_list('train', train_corpus, use_black_list=True)
+        id_valid = self._filter_black_list('valid', valid_corpus, use_black_list=True)
+        id_test = self._filter_black_list('test', self.id_test_corpus, use_black_list=False)
         return Pack(train=id_train, valid=id_valid, test=id_test)
 
     def get_domain_meta(self):
@@ -434,55 +711,89 @@ class SimDialCorpus(object):
 
         return id_domain_meta
 
+    def _build_seed_index(self):
+        """
+        Index the id'd corpus once for get_seed_responses. For every domain
+        and speaker (None stands for any speaker) keep the turns with actions
+        whose utterance was not seen before, in corpus order, together with
+        the rank of their dialog within the domain.
+        """
+        self._domain_dialogs = OrderedDict()
+        for d_id, d in enumerate(self.id_corpus):
+            self._domain_dialogs.setdefault(d[1].domain, []).append(d_id)
+
+        self._seed_index = OrderedDict()
+        msg_cnt = 0
+        for domain, ids in self._domain_dialogs.items():
+            by_speaker = {}
+            seen = defaultdict(set)
+            for rank, d_id in enumerate(ids):
+                for msg in self.id_corpus[d_id]:
+                    if 'actions' not in msg:
+                        continue
+                    msg_cnt += 1
+                    utt_key = tuple(msg.utt)
+                    for speaker in [None, msg.speaker]:
+                        if utt_key in seen[speaker]:
+                            continue
+                        seen[speaker].add(utt_key)
+                        entries = by_speaker.setdefault(speaker, Pack(ranks=[], orders=[], utt_keys=[], msgs=[]))
+                        entries.ranks.append(rank)
+                        entries.orders.append(msg_cnt)
+                        entries.utt_keys.append(utt_key)
+                        entries.msgs.append(msg)
+            self._seed_index[domain] = by_speaker
+        logging.info("Indexed seed responses of {} domains".format(len(self._seed_index)))
+
+    def _seed_entries(self, by_speaker, speakers):
+        """
+        :return: the index entries of the speakers, deduplicated by utterance
+        """
+        if speakers is None:
+            return by_speaker.get(None)
+        speakers = [s for s in set(speakers) if s in by_speaker]
+        if len(speakers) == 1:
+            return by_speaker[speakers[0]]
+
+        # several speakers, merge their entries in corpus order
+        merged = Pack(ranks=[], orders=[], utt_keys=[], msgs=[])
+        seen = set()
+        streams = [zip(by_speaker[s].orders, by_speaker[s].ranks, by_speaker[s].utt_keys, by_speaker[s].msgs)
+                   for s in speakers]
+        for order, rank, utt_key, msg in heapq.merge(*streams):
+            if utt_key in seen:
+                continue
+            seen.add(utt_key)
+            merged.ranks.append(rank)
+            merged.orders.append(order)
+            merged.utt_keys.append(utt_key)
+            merged.msgs.append(msg)
+        return merged
+
     def get_seed_responses(self, utt_cnt=100, domains=None, speakers=None):
+        """
+        :return: per domain, the first utt_cnt distinct turns with actions
+        from the first utt_cnt // 10 dialogs of that domain
+        """
         if utt_cnt == 0 or self.config.action_match is False:
             return []
 
         # estimate how many dialogs we need.
-        dialog_cnt = utt_cnt/10
-
-        # find all domains IDs
-        id2domains = defaultdict(list)
-        for d_id, d in enumerate(self.corpus):
-            id2domains[d[1].domain].append(d_id)
+        dialog_cnt = utt_cnt // 10
 
         black_sys_utts = []
         all_domains = []
 
-        for domain, ids in id2domains.items():
-            selected_ids = []
-
-            if domains is None or domain in domains:
-                selected_ids.extend(ids[0:dialog_cnt])
-
-            data = [self.corpus[idx] for idx in selected_ids]
-            id_selected_data = self._to_id_corpus('Extra', data, use_black_list=False)
-
-            domain_responses = {}
-            # prepare the container
-            for dialog in id_selected_data:
-                for msg in dialog:
-                    if speakers is None or msg.speaker in speakers:
-                        if 'actions' not in msg:
-                            continue
-
-                        if len(domain_responses) >= utt_cnt:
-                            break
-                        domain = msg.get('domain')
-                        utt = " ".join(map(str, msg.utt))
-                        if utt not in domain_responses:
-                            domain_responses[utt] = (msg, domain)
-
-                        #all_domains.append(domain)
-                        #black_sys_utts.append(msg)
-                        #domain_cnt +=1
-                if len(domain_responses) > utt_cnt:
-                    break
-
-            for msg, domain in domain_responses.values():
+        for domain, by_speaker in self._seed_index.items():
+            if domains is not None and domain not in domains:
+                continue
+            entries = self._seed_entries(by_speaker, speakers)
+            if not entries:
+                continue
+            end = min(bisect.bisect_left(entries.ranks, dialog_cnt), utt_cnt)
+            for msg in entries.msgs[0:end]:
                 black_sys_utts.append(msg)
-                all_domains.append(domain)
-
+                all_domains.append(msg.get('domain'))
 
         logging.info("Collected {} extra samples".format(len(black_sys_utts)))
         logging.info(Counter(all_domains).most_common())
@@ -492,63 +803,166 @@ class SimDialCorpus(object):
         """
         :return: all system utterances -> actions 
         """
-        data = self.corpus + self.test_corpus
         utt2act = []
-        for dialog in data:
-            for msg in dialog:
-                if msg.speaker == speaker:
-                    utt2act.append(Pack(utt=msg.utt, actions=msg.actions, domain=msg.domain))
+        for msg in self.turn_corpus:
+            if msg.speaker == speaker:
+                utt2act.append(Pack(utt=msg.utt, actions=msg.actions, domain=msg.domain))
         return utt2act
 
 
 class ZslStanfordCorpus(object):
 
-    def __init__(self, config):
+    def __init__(self, config, session_dir=None):
+        """
+        :param session_dir: a trained session to evaluate. If it has a saved
+        corpus, only the test split is read with the saved vocabulary.
+        """
         self.config = config
         self._path = config.data_dir[0]
         self.max_utt_len = config.max_utt_len
         self.tokenize = get_tokenize()
         self.black_domains = config.black_domains
         self.black_ratio = config.black_ratio
-        self.train_corpus = self._read_file(os.path.join(self._path, 'kvret_train_public.json'))
-        self.valid_corpus = self._read_file(os.path.join(self._path, 'kvret_dev_public.json'))
-        self.test_corpus = self._read_file(os.path.join(self._path, 'kvret_test_public.json'))
+        self.compact = getattr(config, 'compact_corpus', False)
+        self._pool = None
         with open(os.path.join(self._path, 'kvret_entities.json'), 'rb') as f:
             self.ent_metas = json.load(f)
-        self.domain_descriptions = self._read_domain_descriptions(self._path)
+
+        session = load_session_corpus(session_dir) if session_dir is not None else None
+        if session is not None:
+            self._load_test_split(*session)
+            print("Done loading corpus")
+            return
+
+        cache = self._get_cache()
+        if cache is not None and cache.exists():
+            self._load_cache(cache)
+            print("Done loading corpus")
+            return
+
+        self._pool = get_worker_pool(getattr(config, 'preprocess_workers', 1))
+        try:
+            self.train_corpus = self._read_file(os.path.join(self._path, 'kvret_train_public.json'))
+            self.valid_corpus = self._read_file(os.path.join(self._path, 'kvret_dev_public.json'))
+            self.test_corpus = self._read_file(os.path.join(self._path, 'kvret_test_public.json'))
+            self.domain_descriptions = self._read_domain_descriptions(self._path)
+        finally:
+            if self._pool is not None:
+                self._pool.terminate()
+            self._pool = None
         self._build_vocab()
+
+        # convert to IDs once, black listed dialogs are filtered in get_corpus
+        self._kb_matrices = []
+        self.id_train_corpus = self._to_id_corpus("Train", self.train_corpus)
+        self.id_valid_corpus = self._to_id_corpus("Valid", self.valid_corpus)
+        self.id_test_corpus = self._to_id_corpus("Test", self.test_corpus)
+        self.kb_table = KBTable.from_matrices(self._kb_matrices, self.max_utt_len)
+        del self._kb_matrices
+        logging.info("{} KB tables with {} rows take {:.2f}MB".format(
+            len(self.kb_table), len(self.kb_table.rows), self.kb_table.nbytes() / 1e6))
+        logging.info(self.tokenize.summary())
+        if self.compact:
+            self.id_train_corpus = CompactDialogCorpus.from_dialogs(self.id_train_corpus, 'Train')
+            self.id_valid_corpus = CompactDialogCorpus.from_dialogs(self.id_valid_corpus, 'Valid')
+            self.id_test_corpus = CompactDialogCorpus.from_dialogs(self.id_test_corpus, 'Test')
+        if cache is not None:
+            self._save_cache(cache)
         print("Done loading corpus")
 
+    def save_session(self, session_dir):
+        """
+        Save the vocabulary, which is all a forward_only run needs from training.
+        """
+        save_session_corpus(session_dir, self.vocab.to_array(), {})
+
+    def _load_test_split(self, vocab, meta):
+        """
+        Read the test split only, with the vocabulary of the saved session.
+        There is no train data, so no seed responses.
+        """
+        self.vocab = Vocabulary(vocab, unk=UNK, pad=PAD)
+        self.rev_vocab = self.vocab.rev_vocab
+        self.unk_id = self.vocab.unk_id
+        self.domain_descriptions = []
+
+        self._pool = get_worker_pool(getattr(self.config, 'preprocess_workers', 1))
+        try:
+            self.test_corpus = self._read_file(os.path.join(self._path, 'kvret_test_public.json'))
+        finally:
+            if self._pool is not None:
+                self._pool.terminate()
+            self._pool = None
+        self._kb_matrices = []
+        self.id_test_corpus = self._to_id_corpus("Test", self.test_corpus)
+        self.kb_table = KBTable.from_matrices(self._kb_matrices, self.max_utt_len)
+        del self._kb_matrices
+        if self.compact:
+            self.id_test_corpus = CompactDialogCorpus.from_dialogs(self.id_test_corpus, 'Test')
+        self.train_corpus, self.valid_corpus = [], []
+        self.id_train_corpus, self.id_valid_corpus = [], []
+        print("Load test split with %d dialogs" % len(self.id_test_corpus))
+
+    def _get_cache(self):
+        if not getattr(self.config, 'use_cache', False):
+            return None
+        paths = [os.path.join(self._path, f) for f in ['kvret_train_public.json',
+                                                       'kvret_dev_public.json',
+                                                       'kvret_test_public.json']]
+        paths += [os.path.join(self._path, 'domain_descriptions/{}.tsv'.format(d))
+                  for d in ['navigate', 'schedule', 'weather']]
+        settings = {'max_utt_len': self.max_utt_len,
+                    'include_domain': self.config.include_domain}
+        return CorpusCache(self.config.cache_dir, 'stanford', paths, settings)
+
+    def _save_cache(self, cache):
+        arrays, meta = {}, {}
+        for name, data in [('train', self.id_train_corpus),
+                           ('valid', self.id_valid_corpus),
+                           ('test', self.id_test_corpus)]:
+            split_arrays, meta[name] = corpus_to_arrays(data)
+            arrays.update(CorpusCache.prefix(split_arrays, name))
+        arrays['vocab'] = self.vocab.to_array()
+        arrays['kb_rows'] = self.kb_table.rows
+        arrays['kb_offsets'] = self.kb_table.offsets
+        meta['domain_descriptions'] = self.domain_descriptions
+        cache.save(arrays, meta)
+
+    def _load_cache(self, cache):
+        arrays, meta = cache.load()
+        self.vocab = Vocabulary(arrays['vocab'].tolist(), unk=UNK, pad=PAD)
+        self.rev_vocab = self.vocab.rev_vocab
+        self.unk_id = self.vocab.unk_id
+        self.kb_table = KBTable(arrays['kb_rows'], arrays['kb_offsets'])
+        self.domain_descriptions = to_pack(meta['domain_descriptions'])
+        # only the compact corpus keeps the memory-mapped arrays, shared between processes
+        load_func = CompactDialogCorpus if self.compact else arrays_to_dialogs
+        self.id_train_corpus = load_func(CorpusCache.unprefix(arrays, 'train'), meta['train'])
+        self.id_valid_corpus = load_func(CorpusCache.unprefix(arrays, 'valid'), meta['valid'])
+        self.id_test_corpus = load_func(CorpusCache.unprefix(arrays, 'test'), meta['test'])
+        print("Load corpus with train size %d, valid size %d, test size %d vocab size %d"
+              % (len(self.id_train_corpus), len(self.id_valid_corpus),
+                 len(self.id_test_corpus), len(self.vocab)))
+
     def _read_domain_descriptions(self, path):
         # read all domains
-        seed_responses = []
-        speaker_map = {'assistant': SYS, 'driver': USR}
+        lines = []
 
         def _read_file(domain):
             with open(os.path.join(path, 'domain_descriptions/{}.tsv'.format(domain)), 'r') as f:
-                lines = f.readlines()
-                
-                for l in lines[1:]:
+                for l in f.readlines()[1:]:
                     tokens = l.split('\t')
                     if tokens[2] == "":
                         break
-                    utt = tokens[1]
-                    speaker = tokens[0]
-                    action = tokens[3]
-                    if self.config.include_domain:
-                        utt = [BOS, speaker_map[speaker], domain] + self.tokenize(utt) + [EOS]
-                        action = [BOS, speaker_map[speaker], domain] + self.tokenize(action) + [EOS]
-                    else:
-                        utt = [BOS, speaker_map[speaker]] + self.tokenize(utt) + [EOS]
-                        action = [BOS, speaker_map[speaker]] + self.tokenize(action) + [EOS]
-
-                    seed_responses.append(Pack(domain=domain, speaker=speaker,
-                                               utt=utt, actions=action))
+                    lines.append((domain, tokens))
 
         _read_file('navigate')
         _read_file('schedule')
         _read_file('weather')
-        return seed_responses
+
+        norm_func = partial(_norm_smd_seed, include_domain=self.config.include_domain)
+        workers = getattr(self.config, 'preprocess_workers', 1)
+        return list(parallel_map(norm_func, lines, self._pool, workers))
 
     def _read_file(self, path):
         with open(path, 'rb') as f:
@@ -560,30 +974,10 @@ class ZslStanfordCorpus(object):
         new_dialog = []
         all_lens = []
         all_dialog_lens = []
-        speaker_map = {'assistant': SYS, 'driver': USR}
-        for raw_dialog in data:
-            domain = raw_dialog['scenario']['task']['intent']
-            kb_items = []
-            if raw_dialog['scenario']['kb']['items'] is not None:
-                for item in raw_dialog['scenario']['kb']['items']:
-                    kb_items.append([KB]+self.tokenize(" ".join(["{} {}".format(k, v) for k, v in item.items()])))
-
-            dialog = [Pack(utt=[BOS, domain, BOD, EOS], speaker=USR, slots=None, domain=domain)]
-            for turn in raw_dialog['dialogue']:
-                utt = turn['data']['utterance']
-                slots = turn['data'].get('slots')
-                speaker = speaker_map[turn['turn']]
-                if self.config.include_domain:
-                    utt = [BOS, speaker, domain] + self.tokenize(utt) + [EOS]
-                else:
-                    utt = [BOS, speaker] + self.tokenize(utt) + [EOS]
-
-                all_lens.append(len(utt))
-                if speaker == SYS:
-                    dialog.append(Pack(utt=utt, speaker=speaker, slots=slots, domain=domain, kb=kb_items))
-                else:
-                    dialog.append(Pack(utt=utt, speaker=speaker, slots=slots, domain=domain, kb=[]))
-
+        norm_func = partial(_norm_smd_dialog, include_domain=self.config.include_domain)
+        workers = getattr(self.config, 'preprocess_workers', 1)
+        for dialog in parallel_map(norm_func, data, self._pool, workers):
+            all_lens.extend([len(turn.utt) for turn in dialog[1:]])
             all_dialog_lens.append(len(dialog))
             new_dialog.append(dialog)
 
@@ -616,18 +1010,58 @@ class ZslStanfordCorpus(object):
                  raw_vocab_size, len(vocab_count), vocab_count[-1][1],
                  float(discard_wc) / len(all_words)))
 
-        self.vocab = [PAD, UNK, SYS, USR] + [t for t, cnt in vocab_count]
-        self.rev_vocab = {t: idx for idx, t in enumerate(self.vocab)}
-        self.unk_id = self.rev_vocab[UNK]
+        self.vocab = Vocabulary([PAD, UNK, SYS, USR] + [t for t, cnt in vocab_count], unk=UNK, pad=PAD)
+        self.rev_vocab = self.vocab.rev_vocab
+        self.unk_id = self.vocab.unk_id
 
     def _sent2id(self, sent):
-        return [self.rev_vocab.get(t, self.unk_id) for t in sent]
+        return [self.rev_vocab[t] for t in sent]
 
-    def _to_id_corpus(self, name, data, use_black_list):
+    def _add_kb(self, kb):
+        """
+        Pad the KB rows to max_utt_len like the data loader pads utterances
+        :return: the id of the new table in kb_table
+        """
+        matrix = np.zeros((len(kb), self.max_utt_len), dtype=np.int32)
+        for r_id, item in enumerate(kb):
+            item = self._sent2id(item)
+            if len(item) >= self.max_utt_len:
+                item = item[0:self.max_utt_len - 1] + [item[-1]]
+            matrix[r_id, 0:len(item)] = item
+        self._kb_matrices.append(matrix)
+        return len(self._kb_matrices) - 1
+
+    def _to_id_corpus(self, name, data):
         results = []
+        for dialog in data:
+            temp = []
+            # the SYS turns of a dialog share one KB list, convert it once
+            kb_ids = {}
+            # convert utterance and feature into numeric numbers
+            for turn in dialog:
+                kb = turn.get('kb')
+                if not kb:
+                    kb_id = -1
+                elif id(kb) in kb_ids:
+                    kb_id = kb_ids[id(kb)]
+                else:
+                    kb_id = kb_ids[id(kb)] = self._add_kb(kb)
+                id_turn = Pack(utt=self._sent2id(turn.utt),
+                               speaker=turn.speaker,
+                               domain=turn.domain,
+                               domain_id=self.rev_vocab[turn.domain],
+                               meta=turn.get('meta'),
+                               kb_id=kb_id)
+                temp.append(id_turn)
+            results.append(temp)
+        logging.info("Converted {} dialogs from {}".format(len(results), name))
+        return results
+
+    def _filter_black_list(self, name, data, use_black_list):
+        keep_ids = []
         kick_cnt = 0
         domain_cnt = []
-        for dialog in data:
+        for d_id, dialog in enumerate(data):
             if len(dialog) < 1:
                 continue
             domain = dialog[0].domain
@@ -637,27 +1071,16 @@ class ZslStanfordCorpus(object):
                     and should_filter:
                 kick_cnt += 1
                 continue
-            temp = []
-            # convert utterance and feature into numeric numbers
-            for turn in dialog:
-                id_turn = Pack(utt=self._sent2id(turn.utt),
-                               speaker=turn.speaker,
-                               domain=turn.domain,
-                               domain_id=self.rev_vocab[domain],
-                               meta=turn.get('meta'),
-                               kb=[self._sent2id(item) for item in turn.get('kb', [])])
-                temp.append(id_turn)
-
-            results.append(temp)
+            keep_ids.append(d_id)
             domain_cnt.append(domain)
         logging.info("Filter {} samples from {}".format(kick_cnt, name))
         logging.info(Counter(domain_cnt).most_common())
-        return results
+        return select_dialogs(data, keep_ids)
 
     def get_corpus(self):
-        id_train = self._to_id_corpus("Train", self.train_corpus, use_black_list=True)
-        id_valid = self._to_id_corpus("Valid", self.valid_corpus, use_black_list=False)
-        id_test = self._to_id_corpus("Test", self.test_corpus, use_black_list=False)
+        id_train = self._filter_black_list("Train", self.id_train_corpus, use_black_list=True)
+        id_valid = self._filter_black_list("Valid", self.id_valid_corpus, use_black_list=False)
+        id_test = self._filter_black_list("Test", self.id_test_corpus, use_black_list=False)
         return Pack(train=id_train, valid=id_valid, test=id_test)
 
     def get_seed_responses(self, utt_cnt=100):
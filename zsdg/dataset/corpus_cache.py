@@ -0,0 +1,320 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+
+import hashlib
+import io
+import json
+import logging
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+from zsdg.utils import Pack
+
+
+def file_digest(path, block_size=1 << 20):
+    """
+    Hash the content of a file
+    :param path: the file path
+    :return: the sha256 hex digest of the file content
+    """
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while True:
+            block = f.read(block_size)
+            if not block:
+                break
+            sha.update(block)
+    return sha.hexdigest()
+
+
+def to_pack(obj):
+    """
+    Recursively turn the dictionaries loaded from JSON back into Packs
+    """
+    if type(obj) is dict:
+        return Pack([(k, to_pack(v)) for k, v in obj.items()])
+    elif type(obj) is list:
+        return [to_pack(v) for v in obj]
+    else:
+        return obj
+
+
+class _Table(object):
+    """Map hashable values (speakers, domains) to small integer codes"""
+
+    def __init__(self, values=None):
+        self.values = list(values) if values else []
+        self.index = {v: i for i, v in enumerate(self.values)}
+
+    def code(self, value):
+        if value not in self.index:
+            self.index[value] = len(self.values)
+            self.values.append(value)
+        return self.index[value]
+
+
+def _offsets(lists):
+    offsets = np.zeros(len(lists) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(l) for l in lists])
+    return offsets
+
+
+def _ragged(lists, dtype=np.int32):
+    offsets = _offsets(lists)
+    data = np.fromiter((t for l in lists for t in l), dtype=dtype, count=int(offsets[-1]))
+    return data, offsets
+
+
+def dialogs_to_arrays(dialogs):
+    """
+    Flatten a list of id'd dialogs into ragged numpy arrays. Only the fields
+    that are consumed after _to_id_corpus are kept: utt, speaker, conf,
+    domain, domain_id, actions, id'd state and kb_id.
+
+    :param dialogs: a list of list of turn Packs
+    :return: (arrays, meta). arrays is a dict of numpy arrays and meta
+    holds the speaker and domain tables in JSON friendly form.
+    """
+    speakers, domains = _Table(), _Table()
+    turns = [turn for dialog in dialogs for turn in dialog]
+
+    has_actions = np.array(['actions' in t for t in turns], dtype=np.bool_)
+    has_state = np.array([type(t.get('state')) is list for t in turns], dtype=np.bool_)
+    state_rows = [t.state if has_state[i] else [] for i, t in enumerate(turns)]
+
+    arrays = {}
+    arrays['dialog_offsets'] = _offsets(dialogs)
+    arrays['utt'], arrays['utt_offsets'] = _ragged([t.utt for t in turns])
+    arrays['speaker'] = np.array([speakers.code(t.speaker) for t in turns], dtype=np.int16)
+    arrays['domain'] = np.array([domains.code(t.get('domain')) for t in turns], dtype=np.int16)
+    arrays['conf'] = np.array([t.get('conf', 1.0) for t in turns], dtype=np.float64)
+    arrays['domain_id'] = np.array([t.get('domain_id', -1) for t in turns], dtype=np.int32)
+    arrays['has_actions'] = has_actions
+    arrays['actions'], arrays['actions_offsets'] = _ragged([t.actions if has_actions[i] else []
+                                                            for i, t in enumerate(turns)])
+    arrays['has_state'] = has_state
+    arrays['state_offsets'] = _offsets(state_rows)
+    arrays['state_cat'], arrays['state_cat_offsets'] = _ragged([s.cat for rows in state_rows for s in rows])
+    arrays['state_real'] = np.array([s.real for rows in state_rows for s in rows],
+                                    dtype=np.float64).reshape(-1, 5)
+    arrays['kb_id'] = np.array([t.get('kb_id', -1) for t in turns], dtype=np.int32)
+
+    meta = {'speakers': speakers.values, 'domains': domains.values,
+            'has_conf': any('conf' in t for t in turns),
+            'has_domain_id': bool(np.any(arrays['domain_id'] >= 0)),
+            'has_kb_id': any('kb_id' in t for t in turns)}
+    return arrays, meta
+
+
+def arrays_to_dialogs(arrays, meta):
+    """
+    The inverse of dialogs_to_arrays
+    :return: a list of list of turn Packs
+    """
+    def rows(data, offsets, s, e):
+        return [data[offsets[i]:offsets[i+1]].tolist() for i in range(s, e)]
+
+    dialog_offsets = arrays['dialog_offsets'].tolist()
+    utt_offsets = arrays['utt_offsets'].tolist()
+    act_offsets = arrays['actions_offsets'].tolist()
+    state_offsets = arrays['state_offsets'].tolist()
+    cat_offsets = arrays['state_cat_offsets'].tolist()
+    kb_id = arrays['kb_id'].tolist()
+    speaker = arrays['speaker'].tolist()
+    domain = arrays['domain'].tolist()
+    conf = arrays['conf'].tolist()
+    domain_id = arrays['domain_id'].tolist()
+    has_actions = arrays['has_actions'].tolist()
+    has_state = arrays['has_state'].tolist()
+    utt, actions, state_cat = arrays['utt'], arrays['actions'], arrays['state_cat']
+    state_real = arrays['state_real']
+
+    dialogs = []
+    for d_id in range(len(dialog_offsets) - 1):
+        dialog = []
+        for t_id in range(dialog_offsets[d_id], dialog_offsets[d_id+1]):
+            turn = Pack(utt=utt[utt_offsets[t_id]:utt_offsets[t_id+1]].tolist(),
+                        speaker=meta['speakers'][speaker[t_id]])
+            if meta['has_conf']:
+                turn['conf'] = conf[t_id]
+            turn_domain = meta['domains'][domain[t_id]]
+            if turn_domain is not None:
+                turn['domain'] = turn_domain
+            if meta['has_domain_id']:
+                turn['domain_id'] = domain_id[t_id]
+                turn['meta'] = None
+            if meta['has_kb_id']:
+                turn['kb_id'] = kb_id[t_id]
+            if has_actions[t_id]:
+                turn['actions'] = actions[act_offsets[t_id]:act_offsets[t_id+1]].tolist()
+            if has_state[t_id]:
+                s, e = state_offsets[t_id], state_offsets[t_id+1]
+                turn['state'] = [Pack(cat=cat, real=real) for cat, real in
+                                 zip(rows(state_cat, cat_offsets, s, e), state_real[s:e].tolist())]
+            dialog.append(turn)
+        dialogs.append(dialog)
+    return dialogs
+
+
+class CorpusCache(object):
+    """
+    A content-addressed on-disk snapshot of a preprocessed corpus. The key
+    is computed from the hashes of the input files and the config fields
+    that change preprocessing, so a stale snapshot is never picked up.
+    Arrays are stored as .npy files and loaded memory-mapped, such that
+    several processes of a sweep share one copy through the page cache.
+
+    :ivar path: the directory of this snapshot
+    """
+    VERSION = 2
+    logger = logging.getLogger()
+
+    def __init__(self, cache_dir, name, input_paths, settings):
+        """
+        :param cache_dir: the root directory of all snapshots
+        :param name: the corpus name
+        :param input_paths: the files the corpus is built from
+        :param settings: a dict of config values that change preprocessing
+        """
+        desc = {'version': self.VERSION, 'name': name,
+                'inputs': [file_digest(p) for p in input_paths],
+                'settings': settings}
+        key = hashlib.sha256(json.dumps(desc, sort_keys=True).encode('utf-8')).hexdigest()
+        self.cache_dir = cache_dir
+        self.path = os.path.join(cache_dir, "{}-{}".format(name, key[0:16]))
+
+    def exists(self):
+        return os.path.exists(os.path.join(self.path, 'meta.json'))
+
+    def save(self, arrays, meta):
+        """
+        Write the snapshot atomically, so a concurrent job never sees a
+        half written directory.
+        :param arrays: a dict of name -> numpy array
+        :param meta: a JSON serializable dict
+        """
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir)
+        tmp_path = tempfile.mkdtemp(dir=self.cache_dir)
+        for name, array in arrays.items():
+            np.save(os.path.join(tmp_path, '{}.npy'.format(name)), array)
+        with io.open(os.path.join(tmp_path, 'meta.json'), 'wb') as f:
+            f.write(json.dumps(meta).encode('utf-8'))
+        try:
+            os.rename(tmp_path, self.path)
+            self.logger.info("Saved corpus snapshot to {}".format(self.path))
+        except OSError:
+            # another process finished the same snapshot first
+            shutil.rmtree(tmp_path, ignore_errors=True)
+
+    def load(self, mmap=True):
+        """
+        :return: (arrays, meta), arrays are memory-mapped when mmap is True
+        """
+        with io.open(os.path.join(self.path, 'meta.json'), 'rb') as f:
+            meta = json.loads(f.read().decode('utf-8'))
+        arrays = {}
+        for f_name in os.listdir(self.path):
+            if f_name.endswith('.npy'):
+                arrays[f_name[0:-4]] = np.load(os.path.join(self.path, f_name),
+                                               mmap_mode='r' if mmap else None)
+        self.logger.info("Loaded corpus snapshot from {}".format(self.path))
+        return arrays, meta
+
+    @staticmethod
+    def prefix(arrays, name):
+        """
+        Namespace a dict of arrays, e.g. to store several corpora in one snapshot
+        """
+        return {"{}.{}".format(name, k): v for k, v in arrays.items()}
+
+    @staticmethod
+    def unprefix(arrays, name):
+        head = "{}.".format(name)
+        return {k[len(head):]: v for k, v in arrays.items() if k.startswith(head)}
+
+
+class ShardCache(object):
+    """
+    Per input file snapshots of the tokenized dialogs. Each shard is keyed
+    by the hash of its own file and the settings, so adding or changing one
+    file of a corpus only reprocesses that file.
+    """
+    VERSION = 1
+    logger = logging.getLogger()
+
+    def __init__(self, cache_dir, name, settings):
+        """
+        :param cache_dir: the root directory of all snapshots
+        :param name: the corpus name
+        :param settings: a dict of config values that change preprocessing
+        """
+        self.shard_dir = os.path.join(cache_dir, 'shards')
+        self.name = name
+        self.settings = settings
+
+    def _path(self, input_path):
+        desc = {'version': self.VERSION, 'name': self.name,
+                'input': file_digest(input_path), 'settings': self.settings}
+        key = hashlib.sha256(json.dumps(desc, sort_keys=True).encode('utf-8')).hexdigest()
+        return os.path.join(self.shard_dir, "{}-{}.json".format(self.name, key[0:16]))
+
+    def load(self, input_path):
+        """
+        :return: the shard of the input file or None if there is no shard yet
+        """
+        path = self._path(input_path)
+        if not os.path.exists(path):
+            return None
+        with io.open(path, 'rb') as f:
+            shard = json.loads(f.read().decode('utf-8'))
+        self.logger.info("Loaded shard of {} from {}".format(input_path, path))
+        return shard
+
+    def save(self, input_path, shard):
+        """
+        :param shard: a JSON serializable dict
+        """
+        if not os.path.exists(self.shard_dir):
+            os.makedirs(self.shard_dir)
+        path = self._path(input_path)
+        fd, tmp_path = tempfile.mkstemp(dir=self.shard_dir)
+        with io.open(fd, 'wb') as f:
+            f.write(json.dumps(shard).encode('utf-8'))
+        os.rename(tmp_path, path)
+        self.logger.info("Saved shard of {} to {}".format(input_path, path))
+
+
+
+SESSION_VOCAB = 'vocab.npy'
+SESSION_META = 'corpus_meta.json'
+
+
+def save_session_corpus(session_dir, vocab, meta):
+    """
+    Save what a later forward_only run needs besides the test split, so it
+    does not have to preprocess the training data again.
+    :param vocab: the numpy array of vocabulary words
+    :param meta: a JSON serializable dict
+    """
+    np.save(os.path.join(session_dir, SESSION_VOCAB), vocab)
+    with io.open(os.path.join(session_dir, SESSION_META), 'wb') as f:
+        f.write(json.dumps(meta).encode('utf-8'))
+
+
+def load_session_corpus(session_dir):
+    """
+    :return: (vocab words, meta) or None if the session has no saved corpus
+    """
+    vocab_path = os.path.join(session_dir, SESSION_VOCAB)
+    meta_path = os.path.join(session_dir, SESSION_META)
+    if not (os.path.exists(vocab_path) and os.path.exists(meta_path)):
+        logging.info("No saved corpus in {}".format(session_dir))
+        return None
+    with io.open(meta_path, 'rb') as f:
+        meta = json.loads(f.read().decode('utf-8'))
+    logging.info("Loaded saved corpus from {}".format(session_dir))
+    return np.load(vocab_path).tolist(), meta
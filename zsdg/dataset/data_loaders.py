@@ -3,183 +3,138 @@ from __future__ import print_function
 import numpy as np
 from zsdg.utils import Pack
 from zsdg.dataset.corpora import SimDialCorpus, SYS, USR
-from zsdg.dataset.dataloader_bases import DataLoader, LongDataLoader
+from zsdg.dataset.dataloader_bases import DataLoader, LongDataLoader, WarmupMixin
+from zsdg.dataset.batch_buffers import make_buffer_ring
 import logging
 
 
-class ZslSMDDialDataLoader(DataLoader):
-    def __init__(self, name, data, config, warmup_data=None):
-        super(ZslSMDDialDataLoader, self).__init__(name)
+class ZslSMDDialDataLoader(WarmupMixin, DataLoader):
+    state_keys = DataLoader.state_keys + ('warmup_batches', 'warmup_flags', 'warmup_num_batch')
+
+    def __init__(self, name, data, kb_table, config, warmup_data=None):
+        super(ZslSMDDialDataLoader, self).__init__(name, rank=getattr(config, 'rank', 0),
+                                                   world_size=getattr(config, 'world_size', 1))
         self.max_utt_size = config.max_utt_len
+        self.kb_table = kb_table
+        self.buffers = make_buffer_ring(config)
+        self.batch_tensors = getattr(config, 'batch_tensors', False)
+        self.cache_batches = getattr(config, 'cache_eval_batches', False)
+        self.id_dtype = np.int64 if self.batch_tensors else np.int32
 
         self.data = self.flatten_dialog(data, config.backward_size)
         self.data_size = len(self.data)
-        data_lens = [len(line.context) for line in self.data]
-        if False:
-            self.indexes = list(np.argsort(data_lens))[::-1]
-        else:
-            self.indexes = range(len(data_lens))
+        # batch_sampler bucket sorts by length, see _bucket_indexes
+        self.indexes = range(self.data_size)
 
-        # prepare indexes for warm up
-        self.warmup_data = warmup_data
-        if self.warmup_data is not None:
-            self.warmup_size = len(self.warmup_data)
-            self.warmup_indexes = range(self.warmup_size)
-        self.warmup_flags = None
-        self.warmup_num_batch = None
+        # pad the seed responses for warm up
+        self._init_warmup(warmup_data, config)
 
     def flatten_dialog(self, data, backward_size):
+        """
+        Pad every turn once into a shared turn table and describe each
+        system response by (dialog_id, start_turn, end_turn): the context
+        is turns [start_turn, end_turn) and the response is end_turn.
+        :return: a [num_response, 3] int array
+        """
+        turn_utts, turn_lens = [], []
+        self.turn_kb_ids, self.turn_domains, self.turn_domain_ids = [], [], []
+        self.dialog_offsets = [0]
         results = []
-        for dialog in data:
-            for i in range(1, len(dialog)):
-                e_id = i
-                s_id = max(0, e_id - backward_size)
-                response = dialog[i].copy()
-                if response.speaker == USR:
-                    continue
-                response['utt'] = self.pad_to(self.max_utt_size, response.utt, do_pad=False)
-                response['kb'] = [self.pad_to(self.max_utt_size, item, do_pad=True) for item in response.kb]
-
-                contexts = []
-                for turn in dialog[s_id:e_id]:
-                    turn['utt'] = self.pad_to(self.max_utt_size, turn.utt, do_pad=False)
-                    contexts.append(turn)
-                results.append(Pack(context=contexts, response=response))
-        return results
+        for d_id, dialog in enumerate(data):
+            for i, turn in enumerate(dialog):
+                utt = self.pad_to(self.max_utt_size, turn.utt, do_pad=False)
+                turn_lens.append(len(utt))
+                turn_utts.append(self.pad_to(self.max_utt_size, utt))
+                self.turn_kb_ids.append(turn.get('kb_id', -1))
+                self.turn_domains.append(turn.get('domain'))
+                self.turn_domain_ids.append(turn.get('domain_id'))
+                if i > 0 and turn.speaker != USR:
+                    results.append((d_id, max(0, i - backward_size), i))
+            self.dialog_offsets.append(len(turn_lens))
+
+        self.turn_utts = np.array(turn_utts, dtype=self.id_dtype).reshape(-1, self.max_utt_size)
+        self.turn_lens = np.array(turn_lens, dtype=np.int64)
+        return np.array(results, dtype=np.int64).reshape(-1, 3)
+
+    def _length_keys(self):
+        # the context is the KB rows plus the dialog turns, the response is one turn
+        starts = np.take(self.dialog_offsets, self.data[:, 0])
+        # kb id -1, i.e. no KB, picks the trailing 0
+        kb_lens = np.append(np.diff(self.kb_table.offsets), 0)
+        kb_ids = np.take(self.turn_kb_ids, starts + self.data[:, 2])
+        ctx_lens = kb_lens[kb_ids] + self.data[:, 2] - self.data[:, 1]
+        return [ctx_lens, self.turn_lens[starts + self.data[:, 2]]]
 
     def epoch_init(self, config, shuffle=True, verbose=True):
         super(ZslSMDDialDataLoader, self).epoch_init(config, shuffle, verbose)
-        self.warmup_flags = [False] * self.num_batch
-
-        if self.warmup_data is None:
-            return
-
-        self.warmup_num_batch = int(self.warmup_size / config.batch_size)
-        for i in range(self.warmup_num_batch):
-            self.batch_indexes.append(np.random.choice(self.warmup_indexes, config.batch_size, replace=False))
-            self.warmup_flags.append(True)
-
-        if shuffle:
-            temp_batch_id = list(range(len(self.warmup_flags)))
-            np.random.shuffle(temp_batch_id)
-            self.batch_indexes = [self.batch_indexes[i] for i in temp_batch_id]
-            self.warmup_flags = [self.warmup_flags[i] for i in temp_batch_id]
-
-        if verbose:
-            self.logger.info("%s add with %d warm up batches" % (self.name, self.warmup_num_batch))
-
-    def next_batch(self):
-        if self.ptr < self.num_batch:
-            is_warmup = self.warmup_flags[self.ptr]
-            selected_ids = self.batch_indexes[self.ptr]
-            self.ptr += 1
-
-            if is_warmup:
-                return self._prepare_warmup_batch(selected_ids)
-            else:
-                return self._prepare_batch(selected_ids)
+        self.batch_indexes = self._add_warmup(self.batch_indexes, config, shuffle, verbose)
+
+    def _get_batch(self, ptr):
+        selected_ids = self.batch_indexes[ptr]
+        if self.warmup_flags[ptr]:
+            return self._prepare_warmup_batch(selected_ids)
         else:
-            return None
+            return self._prepare_batch(selected_ids)
 
     def _prepare_batch(self, selected_index):
-        # the batch index, the starting point and end point for segment
-        rows = [self.data[idx] for idx in selected_index]
-
-        cxt_lens, ctx_utts = [], []
-        out_utts, out_lens = [], []
-        domains, domain_metas = [], []
-
-        for row in rows:
-            in_row, out_row = row.context, row.response
-
-            # source context
-            batch_ctx = []
-            for item in out_row.kb:
-                batch_ctx.append(item)
-            for turn in in_row:
-                batch_ctx.append(self.pad_to(self.max_utt_size, turn.utt))
-
-            cxt_lens.append(len(batch_ctx))
-            ctx_utts.append(batch_ctx)
-
-            # target response
-            out_utt = [t for idx, t in enumerate(out_row.utt)]
-            out_utts.append(out_utt)
-            out_lens.append(len(out_utt))
-            domains.append(out_row.domain)
-            domain_metas.append(out_row.domain_id)
-
-        domain_metas = np.array(domain_metas)
-        vec_ctx_lens = np.array(cxt_lens)
+        # the dialog, the first context turn and the response turn
+        rows = self.data[np.asarray(selected_index)]
+        starts = np.take(self.dialog_offsets, rows[:, 0])
+        s_ids, e_ids = starts + rows[:, 1], starts + rows[:, 2]
+
+        # the KB rows come padded from the shared table, then the context turns
+        kbs = [self.kb_table[self.turn_kb_ids[e_id]] for e_id in e_ids]
+        kb_lens = np.array([len(kb) for kb in kbs])
+        vec_ctx_lens = kb_lens + (e_ids - s_ids)
+        vec_out_lens = self.turn_lens[e_ids]
+        domains = [self.turn_domains[e_id] for e_id in e_ids]
+        domain_metas = self._batch_field('domain_metas', np.array([self.turn_domain_ids[e_id] for e_id in e_ids]))
+
         max_ctx_len = np.max(vec_ctx_lens)
-        vec_ctx_utts = np.zeros((self.batch_size, max_ctx_len, self.max_utt_size), dtype=np.int32)
-        vec_ctx_confs = np.ones((self.batch_size, max_ctx_len), dtype=np.float32)
+        ctx_utts, vec_ctx_utts = self._batch_array('contexts', (len(rows), max_ctx_len, self.max_utt_size), self.id_dtype)
+        ctx_confs, _ = self._batch_array('context_confs', (len(rows), max_ctx_len), np.float32, fill=1)
 
-        vec_out_utts = np.zeros((self.batch_size, np.max(out_lens)), dtype=np.int32)
-        vec_out_lens = np.array(out_lens)
+        out_utts = self._batch_field('outputs', self.turn_utts[e_ids, 0:np.max(vec_out_lens)])
 
-        for b_id in range(self.batch_size):
-            vec_out_utts[b_id, 0:vec_out_lens[b_id]] = out_utts[b_id]
-            vec_ctx_utts[b_id, 0:vec_ctx_lens[b_id], :] = ctx_utts[b_id]
+        for b_id in range(len(rows)):
+            vec_ctx_utts[b_id, 0:kb_lens[b_id], :] = kbs[b_id]
+            vec_ctx_utts[b_id, kb_lens[b_id]:vec_ctx_lens[b_id], :] = self.turn_utts[s_ids[b_id]:e_ids[b_id]]
 
         return Pack(context_lens=vec_ctx_lens,
-                    contexts=vec_ctx_utts,
-                    context_confs=vec_ctx_confs,
+                    contexts=ctx_utts,
+                    context_confs=ctx_confs,
                     output_lens=vec_out_lens,
-                    outputs=vec_out_utts,
+                    outputs=out_utts,
                     domains=domains,
                     domain_metas=domain_metas)
 
-    def _prepare_warmup_batch(self, selected_ids):
-        # the batch index, the starting point and end point for segment
-        rows = [self.warmup_data[idx] for idx in selected_ids]
-        out_utts, out_lens = [], []
-        out_acts, out_act_lens = [], []
-        domains, domain_metas = [], []
-
-        for row in rows:
-            out_utt = [t for idx, t in enumerate(row.utt)]
-
-            # target response
-            out_acts.append(row.actions)
-            out_act_lens.append(len(row.actions))
-
-            out_utts.append(out_utt)
-            out_lens.append(len(out_utt))
+    def _warmup_metas(self, rows):
+        return np.array([row.domain_id for row in rows])
 
-            domains.append(row.domain)
-            domain_metas.append(row.domain_id)
+    def _example_arrays(self):
+        return self.data, self.dialog_offsets, self.turn_utts, self.turn_kb_ids
 
-        vec_out_lens = np.array(out_lens)
-        domain_metas = np.array(domain_metas)
-        vec_out_utts = np.zeros((self.batch_size, np.max(out_lens)), dtype=np.int32)
-        vec_out_acts = np.zeros((self.batch_size, np.max(out_act_lens)), dtype=np.int32)
 
-        for b_id in range(self.batch_size):
-            vec_out_utts[b_id, 0:vec_out_lens[b_id]] = out_utts[b_id]
-            vec_out_acts[b_id, 0:out_act_lens[b_id]] = out_acts[b_id]
+class SimDialDataLoader(WarmupMixin, LongDataLoader):
+    state_keys = LongDataLoader.state_keys + ('warmup_batches', 'warmup_flags', 'warmup_num_batch')
 
-        return Pack(output_lens=vec_out_lens, outputs=vec_out_utts, output_actions=vec_out_acts,
-                    domains=domains, domain_metas=domain_metas)
-
-
-class SimDialDataLoader(LongDataLoader):
     def __init__(self, name, data, domain_meta, config, warmup_data=None):
-        super(SimDialDataLoader, self).__init__(name)
+        super(SimDialDataLoader, self).__init__(name, rank=getattr(config, 'rank', 0),
+                                                world_size=getattr(config, 'world_size', 1))
         self.max_utt_size = config.max_utt_len
+        self.buffers = make_buffer_ring(config)
+        self.batch_tensors = getattr(config, 'batch_tensors', False)
+        self.cache_batches = getattr(config, 'cache_eval_batches', False)
+        self.id_dtype = np.int64 if self.batch_tensors else np.int32
         self.data = data
         self.domain_meta = self.prepare_domain_meta(domain_meta)
         self.data_size = len(data)
         self.data_lens = [len(line) for line in self.data]
         self.indexes = list(np.argsort(self.data_lens))[::-1]
+        self.pack_dialogs(data)
 
-        # prepare indexes for warm up
-        self.warmup_data = warmup_data
-        if self.warmup_data is not None:
-            self.warmup_size = len(self.warmup_data)
-            self.warmup_indexes = range(self.warmup_size)
-        self.warmup_flags = None
-        self.warmup_num_batch = None
+        # pad the seed responses for warm up
+        self._init_warmup(warmup_data, config)
 
         # Pretty printing
         covered_data = np.where(np.array(self.data_lens) < config.backward_size)[0]
@@ -221,165 +176,104 @@ class SimDialDataLoader(LongDataLoader):
 
         return vec_domain_meta
 
+    def pack_dialogs(self, data):
+        """
+        Pack the dialogs once into dense arrays, so a batch is a few numpy
+        gathers. Context turns are padded to [num_dialogs, max_turns,
+        max_utt_len]; responses and actions keep their full length in flat
+        buffers addressed by [num_dialogs, max_turns] offsets and lengths.
+        """
+        num_dialog, max_turn = len(data), max(self.data_lens) if self.data_lens else 0
+        self.turn_utts = np.zeros((num_dialog, max_turn, self.max_utt_size), dtype=self.id_dtype)
+        self.turn_confs = np.zeros((num_dialog, max_turn), dtype=np.float32)
+        self.turn_domains = np.zeros((num_dialog, max_turn), dtype=np.int32)
+        self.out_offsets = np.zeros((num_dialog, max_turn), dtype=np.int64)
+        self.out_lens = np.zeros((num_dialog, max_turn), dtype=np.int64)
+        self.act_offsets = np.zeros((num_dialog, max_turn), dtype=np.int64)
+        self.act_lens = np.zeros((num_dialog, max_turn), dtype=np.int64)
+
+        # turns without a domain get code -1, i.e. the last entry: None and all PAD
+        self.domain_names = [d for d in self.domain_meta.keys()] + [None]
+        domain2code = {d: i for i, d in enumerate(self.domain_names[0:-1])}
+        self.domain_descs = np.zeros((len(self.domain_names), self.max_utt_size), dtype=self.id_dtype)
+        for d, code in domain2code.items():
+            self.domain_descs[code] = self.domain_meta[d].description
+
+        out_buf, act_buf = [], []
+        for d_id, dialog in enumerate(data):
+            for t_id, turn in enumerate(dialog):
+                utt = turn.utt
+                actions = turn.get('actions') or []
+                self.turn_utts[d_id, t_id] = self.pad_to(self.max_utt_size, utt)
+                self.turn_confs[d_id, t_id] = turn.get('conf', 0.0)
+                self.turn_domains[d_id, t_id] = domain2code.get(turn.get('domain'), -1)
+                self.out_offsets[d_id, t_id], self.out_lens[d_id, t_id] = len(out_buf), len(utt)
+                self.act_offsets[d_id, t_id], self.act_lens[d_id, t_id] = len(act_buf), len(actions)
+                out_buf.extend(utt)
+                act_buf.extend(actions)
+        self.out_buf = np.array(out_buf + [0], dtype=self.id_dtype)
+        self.act_buf = np.array(act_buf + [0], dtype=self.id_dtype)
+
+    def _gather_ragged(self, buf, offsets, lens):
+        """
+        :return: a [len(offsets), max(lens)] id_dtype matrix of buf[offset:offset+len] rows, 0 padded
+        """
+        cols = np.arange(np.max(lens))
+        mask = cols[None, :] < lens[:, None]
+        return np.where(mask, buf[np.where(mask, offsets[:, None] + cols[None, :], 0)], 0).astype(self.id_dtype)
+
     def epoch_init(self, config, shuffle=True, verbose=True):
         super(SimDialDataLoader, self).epoch_init(config, shuffle, verbose)
-        self.warmup_flags = [False] * self.num_batch
-
-        if self.warmup_data is None:
-            return
-
-        self.warmup_num_batch = int(self.warmup_size/config.batch_size)
-        for i in range(self.warmup_num_batch):
-            self.grid_indexes.append(np.random.choice(self.warmup_indexes, config.batch_size, replace=False))
-            self.warmup_flags.append(True)
-
-        if shuffle:
-            temp_batch_id = list(range(len(self.warmup_flags)))
-            np.random.shuffle(temp_batch_id)
-            self.grid_indexes = [self.grid_indexes[i] for i in temp_batch_id]
-            self.warmup_flags = [self.warmup_flags[i] for i in temp_batch_id]
-
-        if verbose:
-            self.logger.info("%s add with %d warm up batches" % (self.name, self.warmup_num_batch))
-
-    def next_batch(self):
-        if self.ptr < self.num_batch:
-            is_warmup = self.warmup_flags[self.ptr]
-            current_grid = self.grid_indexes[self.ptr]
-
-            if is_warmup:
-                self.ptr += 1
-                return self._prepare_warmup_batch(current_grid)
-            else:
-                if self.ptr > 0:
-                    prev_grid = self.grid_indexes[self.ptr - 1]
-                else:
-                    prev_grid = None
-                self.ptr += 1
-                return self._prepare_batch(cur_grid=current_grid,
-                                           prev_grid=prev_grid)
+        self.grid_indexes = self._add_warmup(self.grid_indexes, config, shuffle, verbose)
+
+    def _get_batch(self, ptr):
+        current_grid = self.grid_indexes[ptr]
+        if self.warmup_flags[ptr]:
+            return self._prepare_warmup_batch(current_grid)
         else:
-            return None
+            prev_grid = self.grid_indexes[ptr - 1] if ptr > 0 else None
+            return self._prepare_batch(cur_grid=current_grid,
+                                       prev_grid=prev_grid)
 
     def _prepare_batch(self, cur_grid, prev_grid):
         # the batch index, the starting point and end point for segment
         b_id, s_id, e_id = cur_grid
 
-        batch_ids = self.batch_indexes[b_id]
-        rows = [self.data[idx] for idx in batch_ids]
-        cxt_lens, ctx_utts, ctx_confs = [], [], []
-        out_utts, out_lens = [], []
-        out_acts, out_act_lens = [], []
-        # sys_templates, sys_acts, sys_lens = [], [], []
-        # usr_templates, usr_acts, usr_lens = [], [], []
-        domains, domain_metas= [], []
-
-        for row in rows:
-            if s_id < len(row) - 1:
-                if s_id > 0:
-                    cut_row = row[0:1] + row[s_id+1:e_id]
-                else:
-                    cut_row = row[s_id:e_id]
-
-                in_row, out_row = cut_row[0:-1], cut_row[-1]
-                out_utt = out_row.utt
-
-                # source context
-                cxt_lens.append(len(in_row))
-                batch_ctx, batch_confs = [], []
-                for turn in in_row:
-                    batch_ctx.append(self.pad_to(self.max_utt_size, turn.utt))
-                    batch_confs.append(turn.conf)
+        batch_ids = np.asarray(self.batch_indexes[b_id])
+        row_lens = np.take(self.data_lens, batch_ids)
+        if np.any(s_id >= row_lens - 1):
+            raise ValueError("s_id %d larger than row" % s_id)
 
-                ctx_utts.append(batch_ctx)
-                ctx_confs.append(batch_confs)
-
-                # target response
-                out_utts.append(out_utt)
-                out_lens.append(len(out_utt))
-
-                out_acts.append(out_row.actions)
-                out_act_lens.append(len(out_row.actions))
-
-                domains.append(out_row.domain)
-                domain_metas.append(self.domain_meta[out_row.domain].description)
-
-                #sys_templates.append(self.domain_meta[out_row.domain].sys_templates)
-                #sys_acts.append(self.domain_meta[out_row.domain].sys_acts)
-                #sys_lens.append(len(sys_templates[-1]))
-
-                #usr_templates.append(self.domain_meta[out_row.domain].usr_templates)
-                #usr_acts.append(self.domain_meta[out_row.domain].usr_acts)
-                #usr_lens.append(len(usr_templates[-1]))
-
-            else:
-                raise ValueError("s_id %d larger than row" % s_id)
-
-        vec_ctx_lens = np.array(cxt_lens)
+        # a row is cut to turn 0 + turns [s_id+1, end), the last one is the response
+        ends = np.minimum(e_id, row_lens)
+        vec_ctx_lens = ends - 1 - s_id
+        out_turns = ends - 1
         max_ctx_len = np.max(vec_ctx_lens)
-        vec_ctx_utts = np.zeros((self.batch_size, max_ctx_len, self.max_utt_size), dtype=np.int32)
-        vec_ctx_confs = np.zeros((self.batch_size, max_ctx_len), dtype=np.float32)
-
-        vec_out_utts = np.zeros((self.batch_size, np.max(out_lens)), dtype=np.int32)
-        vec_out_acts = np.zeros((self.batch_size, np.max(out_act_lens)), dtype=np.int32)
-        vec_out_lens = np.array(out_lens)
 
-        #vec_sys_templates = np.zeros((self.batch_size, np.max(sys_lens), self.max_utt_size), dtype=np.int32)
-        #vec_sys_acts = np.zeros((self.batch_size, np.max(sys_lens), len(sys_acts[0][0])), dtype=np.int32)
+        ctx_pos = np.arange(max_ctx_len)
+        ctx_mask = ctx_pos[None, :] < vec_ctx_lens[:, None]
+        ctx_turns = np.where(ctx_pos == 0, 0, ctx_pos + s_id)[None, :] * ctx_mask
+        vec_ctx_utts = self._batch_field('contexts',
+                                         self.turn_utts[batch_ids[:, None], ctx_turns] * ctx_mask[:, :, None])
+        vec_ctx_confs = self._batch_field('context_confs', self.turn_confs[batch_ids[:, None], ctx_turns] * ctx_mask)
 
-        #vec_usr_templates = np.zeros((self.batch_size, np.max(usr_lens), self.max_utt_size), dtype=np.int32)
-        #vec_usr_acts = np.zeros((self.batch_size, np.max(usr_lens), len(usr_acts[0][0])), dtype=np.int32)
+        vec_out_lens = self.out_lens[batch_ids, out_turns]
+        vec_out_utts = self._batch_field('outputs', self._gather_ragged(
+            self.out_buf, self.out_offsets[batch_ids, out_turns], vec_out_lens))
+        vec_out_acts = self._batch_field('output_actions', self._gather_ragged(
+            self.act_buf, self.act_offsets[batch_ids, out_turns], self.act_lens[batch_ids, out_turns]))
 
-        vec_domain_metas = np.zeros((self.batch_size, self.max_utt_size), dtype=np.int32)
-
-        for b_id in range(self.batch_size):
-            vec_out_utts[b_id, 0:vec_out_lens[b_id]] = out_utts[b_id]
-            vec_out_acts[b_id, 0:out_act_lens[b_id]] = out_acts[b_id]
-
-            vec_ctx_confs[b_id, 0:vec_ctx_lens[b_id]] = ctx_confs[b_id]
-            vec_ctx_utts[b_id, 0:vec_ctx_lens[b_id], :] = ctx_utts[b_id]
-
-            #vec_sys_templates[b_id, 0:sys_lens[b_id], :] = sys_templates[b_id]
-            #vec_sys_acts[b_id, 0:sys_lens[b_id], :] = sys_acts[b_id]
-
-            vec_domain_metas[b_id, :] = domain_metas[b_id]
-
-            #vec_usr_templates[b_id, 0:usr_lens[b_id], :] = usr_templates[b_id]
-            #vec_usr_acts[b_id, 0:usr_lens[b_id]] = usr_acts[b_id]
+        domain_codes = self.turn_domains[batch_ids, out_turns]
+        domains = [self.domain_names[code] for code in domain_codes]
+        vec_domain_metas = self._batch_field('domain_metas', self.domain_descs[domain_codes])
 
         return Pack(context_lens=vec_ctx_lens, contexts=vec_ctx_utts, context_confs=vec_ctx_confs,
                     output_lens=vec_out_lens, outputs=vec_out_utts, output_actions=vec_out_acts,
                     domains=domains, domain_metas=vec_domain_metas)
 
-    def _prepare_warmup_batch(self, selected_ids):
-        # the batch index, the starting point and end point for segment
-        rows = [self.warmup_data[idx] for idx in selected_ids]
-        out_utts, out_lens = [], []
-        out_acts, out_act_lens = [], []
-        domains, domain_metas = [], []
-
-        for row in rows:
-            out_utt = row.utt
-            # target response
-            out_acts.append(row.actions)
-            out_act_lens.append(len(row.actions))
-
-            out_utts.append(out_utt)
-            out_lens.append(len(out_utt))
-
-            domains.append(row.domain)
-            domain_metas.append(self.domain_meta[row.domain].description)
-
-        vec_out_lens = np.array(out_lens)
-        vec_out_utts = np.zeros((self.batch_size, np.max(out_lens)), dtype=np.int32)
-        vec_out_acts = np.zeros((self.batch_size, np.max(out_act_lens)), dtype=np.int32)
-        vec_domain_metas = np.zeros((self.batch_size, self.max_utt_size), dtype=np.int32)
-
-        for b_id in range(self.batch_size):
-            vec_out_utts[b_id, 0:vec_out_lens[b_id]] = out_utts[b_id]
-            vec_out_acts[b_id, 0:out_act_lens[b_id]] = out_acts[b_id]
-            vec_domain_metas[b_id, :] = domain_metas[b_id]
-
-        return Pack(output_lens=vec_out_lens, outputs=vec_out_utts, output_actions=vec_out_acts,
-                    domains=domains, domain_metas=vec_domain_metas)
+    def _warmup_metas(self, rows):
+        return np.array([self.domain_meta[row.domain].description for row in rows], dtype=self.id_dtype)
+
+    def _example_arrays(self):
+        return self.turn_utts, self.out_offsets, self.out_lens, self.out_buf, self.act_buf
 
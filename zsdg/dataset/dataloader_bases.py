@@ -1,12 +1,163 @@
 from __future__ import print_function
 import numpy as np
 import logging
+import hashlib
+from zsdg.utils import Pack
+from zsdg.dataset.batch_buffers import to_tensors
 
 
-class DataLoader(object):
+class BaseDataLoader(object):
+    """
+    What DataLoader and LongDataLoader share.
+
+    :ivar buffers: a BatchBufferRing to build the batches in, or None
+    :ivar batch_tensors: return the model inputs as torch tensors
+    :ivar id_dtype: the dtype of the word ids in the batches
+    :ivar rank: the process of data parallel training this loader serves
+    :ivar world_size: the number of processes, each gets its own shard of
+    the shuffled epochs
+    :ivar cache_batches: keep the batches of unshuffled epochs once built
+    :ivar name: the name of the this data loader
+    """
+    # the attributes an epoch changes, see state_dict
+    state_keys = ()
+
+    def __init__(self, name, rank=0, world_size=1):
+        if not 0 <= rank < world_size:
+            raise ValueError("rank %d is not in [0, %d)" % (rank, world_size))
+        self.buffers = None
+        self.batch_tensors = False
+        self.id_dtype = np.int32
+        self.rank = rank
+        self.world_size = world_size
+        self.cache_batches = False
+        self.cached_epoch = False
+        self._batch_cache = None
+        self.name = name
+
+    def _init_batch_cache(self, config, shuffle):
+        """
+        Serve the unshuffled epochs, i.e. validation and generation, from a
+        cache of built batches if cache_batches. Their order only depends on
+        the batch settings, so the cache lives until one of them changes.
+        """
+        self.cached_epoch = self.cache_batches and not shuffle
+        if not self.cached_epoch:
+            return
+        key = (self.batch_size, config.backward_size, getattr(config, 'step_size', None),
+               getattr(config, 'max_tokens_per_batch', 0), getattr(config, 'batch_sampler', 'default'))
+        if self._batch_cache is None or self._batch_cache[0] != key:
+            self._batch_cache = (key, {})
+
+    def _cache_complete(self):
+        """
+        :return: True if every batch of this cached epoch is built
+        """
+        return self.cached_epoch and len(self._batch_cache[1]) >= self.num_batch
+
+    def _cached_batch(self, ptr):
+        batches = self._batch_cache[1]
+        if ptr not in batches:
+            # the ring reuses its buffers, a cached batch needs its own arrays
+            buffers, self.buffers = self.buffers, None
+            try:
+                batch = self._get_batch(ptr)
+            finally:
+                self.buffers = buffers
+            batches[ptr] = to_tensors(batch) if self.batch_tensors else batch
+        return batches[ptr]
+
+    def _shard(self, batches, shuffle):
+        """
+        :return: the batches of this rank for data parallel training, every
+        world_size-th one from rank on. The last len(batches) % world_size
+        batches are dropped so that all ranks get as many. Unshuffled
+        epochs, i.e. validation and generation, keep every batch.
+        """
+        if self.world_size <= 1 or not shuffle:
+            return batches
+        num_batch = len(batches) // self.world_size * self.world_size
+        return batches[self.rank:num_batch:self.world_size]
+
+    def state_dict(self):
+        """
+        :return: the epoch state, enough to continue at the next batch
+        after load_state_dict. The random state is the caller's to save.
+        """
+        return dict((key, getattr(self, key)) for key in self.state_keys)
+
+    def load_state_dict(self, state):
+        for key in self.state_keys:
+            setattr(self, key, state[key])
+
+    def _make_batch(self, ptr):
+        """
+        _get_batch in the next buffers of the ring, as torch tensors if
+        batch_tensors, or the cached batch in a cached epoch
+        """
+        if self.cached_epoch:
+            return self._cached_batch(ptr)
+        if self.buffers is not None:
+            self.buffers.next_slot()
+        batch = self._get_batch(ptr)
+        if self.batch_tensors:
+            batch = to_tensors(batch)
+        return batch
+
+    def next_batch(self):
+        if self.ptr < self.num_batch:
+            batch = self._make_batch(self.ptr)
+            self.ptr += 1
+            return batch
+        else:
+            return None
+
+    def _example_arrays(self):
+        """
+        :return: the arrays that hold the examples of the loader
+        """
+        return ()
+
+    def fingerprint(self):
+        """
+        :return: a hash of the examples, independent of id_dtype, so a
+        checkpoint is only resumed on the data it was trained on
+        """
+        md5 = hashlib.md5()
+        for array in self._example_arrays():
+            array = np.ascontiguousarray(array, dtype=np.int64)
+            md5.update(str(array.shape).encode('utf-8'))
+            md5.update(array.tobytes())
+        return md5.hexdigest()
+
+    def _batch_array(self, name, shape, dtype, fill=0):
+        """
+        :return: (value, array), the batch field and the numpy array to write
+        it through. Without a buffer ring both are the same new array.
+        """
+        if self.buffers is None:
+            array = np.full(shape, fill, dtype=dtype)
+            return array, array
+        return self.buffers.get(name, shape, dtype, fill)
+
+    def _batch_field(self, name, array):
+        """
+        :return: array, or a copy of it in the buffer ring if it is on
+        """
+        if self.buffers is None:
+            return array
+        value, buf = self.buffers.get(name, array.shape, array.dtype)
+        buf[...] = array
+        return value
+
+
+class DataLoader(BaseDataLoader):
     logger = logging.getLogger()
+    # the attributes an epoch changes, see state_dict
+    state_keys = ('batch_size', 'ptr', 'num_batch', 'indexes', 'batch_indexes')
 
-    def __init__(self, name, fix_batch=True):
+    def __init__(self, name, fix_batch=True, rank=0, world_size=1):
+        super(DataLoader, self).__init__(name, rank, world_size)
         self.batch_size = 0
         self.ptr = 0
         self.num_batch = None
@@ -15,7 +166,6 @@ class DataLoader(object):
         self.batch_indexes = None
         self.fix_batch=fix_batch
         self.max_utt_size = None
-        self.name = name
 
     def _shuffle_indexes(self):
         np.random.shuffle(self.indexes)
@@ -26,34 +176,108 @@ class DataLoader(object):
     def _prepare_batch(self, *args, **kwargs):
         raise NotImplementedError("Have to override prepare batch")
 
+    def _length_keys(self):
+        """
+        :return: [context lengths in utterances, response lengths in words],
+        the per example arrays that decide the padding of a batch, or None
+        if unknown
+        """
+        return None
+
+    def _token_batches(self, indexes, keys, max_tokens):
+        """
+        Cut indexes greedily into batches whose padded context words plus
+        response words, n * (max_ctx_len * max_utt_size + max_out_len), stay
+        within max_tokens. An example over the budget gets its own batch.
+        """
+        ctx_lens, out_lens = np.asarray(keys[0]), np.asarray(keys[1])
+        batches, cur, max_ctx, max_out = [], [], 0, 0
+        for idx in indexes:
+            new_ctx, new_out = max(max_ctx, ctx_lens[idx]), max(max_out, out_lens[idx])
+            if cur and (len(cur) + 1) * (new_ctx * self.max_utt_size + new_out) > max_tokens:
+                batches.append(cur)
+                cur, new_ctx, new_out = [], ctx_lens[idx], out_lens[idx]
+            cur.append(idx)
+            max_ctx, max_out = new_ctx, new_out
+        if cur:
+            batches.append(cur)
+        return batches
+
+    def _bucket_indexes(self, keys, shuffle):
+        """
+        Sort the examples by keys, so every batch holds examples of similar
+        lengths. Ties are broken randomly if shuffle, so batches differ
+        between epochs.
+        """
+        if shuffle:
+            ties = np.random.permutation(self.data_size)
+        else:
+            ties = np.arange(self.data_size)
+        return np.lexsort([ties] + [np.asarray(k) for k in keys[::-1]]).tolist()
+
+    def _log_padding(self, keys):
+        ratios = []
+        for lens in keys:
+            lens = np.asarray(lens)
+            used, padded = 0, 0
+            for b_ids in self.batch_indexes:
+                b_lens = lens[np.asarray(b_ids)]
+                used += np.sum(b_lens)
+                padded += len(b_lens) * np.max(b_lens)
+            ratios.append(1.0 - used / float(max(padded, 1)))
+        self.logger.info("%s padding ratio %s" % (self.name, " ".join("%.3f" % r for r in ratios)))
+
     def epoch_init(self, config, shuffle=True, verbose=True):
         self.ptr = 0
         self.batch_size = config.batch_size
-        self.num_batch = self.data_size // config.batch_size
-        if verbose:
-            self.logger.info("Number of left over sample %d" % (self.data_size - config.batch_size * self.num_batch))
+        keys = self._length_keys()
+        max_tokens = getattr(config, 'max_tokens_per_batch', 0)
+        if max_tokens > 0 and keys is None:
+            raise ValueError("%s does not support max_tokens_per_batch" % self.name)
 
-        # if shuffle and we want to group lines, shuffle batch indexes
-        if shuffle and not self.fix_batch:
+        if max_tokens > 0:
+            self.num_batch = None
+        else:
+            self.num_batch = self.data_size // config.batch_size
+            if verbose:
+                self.logger.info("Number of left over sample %d" % (self.data_size - config.batch_size * self.num_batch))
+
+        bucket = getattr(config, 'batch_sampler', 'default') == 'bucket' and keys is not None
+        indexes = self.indexes
+        if bucket:
+            # the buckets are shuffled below as whole batches
+            indexes = self._bucket_indexes(keys, shuffle)
+        elif shuffle and not self.fix_batch:
+            # if shuffle and we want to group lines, shuffle batch indexes
             self._shuffle_indexes()
+            indexes = self.indexes
+            # the unshuffled epochs change too
+            self._batch_cache = None
 
-        self.batch_indexes = []
-        for i in range(self.num_batch):
-            self.batch_indexes.append(self.indexes[i * self.batch_size:(i + 1) * self.batch_size])
+        if max_tokens > 0:
+            self.batch_indexes = self._token_batches(indexes, keys, max_tokens)
+            self.num_batch = len(self.batch_indexes)
+        else:
+            self.batch_indexes = []
+            for i in range(self.num_batch):
+                self.batch_indexes.append(indexes[i * self.batch_size:(i + 1) * self.batch_size])
 
-        if shuffle and self.fix_batch:
+        if shuffle and (self.fix_batch or bucket):
             self._shuffle_batch_indexes()
+        self.batch_indexes = self._shard(self.batch_indexes, shuffle)
+        self.num_batch = len(self.batch_indexes)
 
         if verbose:
             self.logger.info("%s begins with %d batches" % (self.name, self.num_batch))
+        if keys is not None and (verbose or shuffle):
+            self._log_padding(keys)
+        self._init_batch_cache(config, shuffle)
 
-    def next_batch(self):
-        if self.ptr < self.num_batch:
-            selected_ids = self.batch_indexes[self.ptr]
-            self.ptr += 1
-            return self._prepare_batch(selected_index=selected_ids)
-        else:
-            return None
+    def _get_batch(self, ptr):
+        """
+        Build the batch at position ptr of the epoch, without moving ptr
+        """
+        return self._prepare_batch(selected_index=self.batch_indexes[ptr])
 
     def pad_to(self, max_len, tokens, do_pad=True):
         if len(tokens) >= max_len:
@@ -64,7 +288,7 @@ class DataLoader(object):
             return tokens
 
 
-class LongDataLoader(object):
+class LongDataLoader(BaseDataLoader):
     """A special efficient data loader for TBPTT. Assume the data contains
     N long sequences, each sequence has length k_i
 
@@ -84,8 +308,12 @@ class LongDataLoader(object):
     :ivar name: the name of the this data loader
     """
     logger = logging.getLogger()
+    # the attributes an epoch changes, see state_dict
+    state_keys = ('batch_size', 'backward_size', 'step_size', 'ptr', 'num_batch',
+                  'batch_indexes', 'grid_indexes')
 
-    def __init__(self, name):
+    def __init__(self, name, rank=0, world_size=1):
+        super(LongDataLoader, self).__init__(name, rank, world_size)
         self.batch_size = 0
         self.backward_size = 0
         self.step_size = 0
@@ -96,7 +324,8 @@ class LongDataLoader(object):
         self.indexes = None
         self.data_lens = None
         self.data_size = None
-        self.name = name
+        self.max_utt_size = None
+        self._grid_cache = None
 
     def _shuffle_batch_indexes(self):
         np.random.shuffle(self.batch_indexes)
@@ -107,6 +336,89 @@ class LongDataLoader(object):
     def _prepare_batch(self, cur_grid, prev_grid):
         raise NotImplementedError("Have to override prepare batch")
 
+    def _bucket_indexes(self, shuffle):
+        """
+        Sort the sequences from the longest to the shortest like the default
+        order, but break ties randomly if shuffle, so the batches of equal
+        length sequences differ between epochs.
+        """
+        if shuffle:
+            ties = np.random.permutation(self.data_size)
+        else:
+            ties = np.arange(self.data_size)
+        return np.lexsort((ties, -np.asarray(self.data_lens))).tolist()
+
+    def _token_batches(self, indexes, max_tokens):
+        """
+        Cut the longest first indexes greedily into batches whose windows,
+        n * (min(k_max, backward_size) + 1) * max_utt_size words for the
+        context and the response, stay within max_tokens.
+        """
+        utt_size = self.max_utt_size or 1
+        batches, cur = [], []
+        for idx in indexes:
+            if cur:
+                window = min(self.data_lens[cur[0]], self.backward_size) + 1
+                if (len(cur) + 1) * window * utt_size > max_tokens:
+                    batches.append(cur)
+                    cur = []
+            cur.append(idx)
+        if cur:
+            batches.append(cur)
+        return batches
+
+    def _grid_table(self, batch_indexes):
+        """
+        The TBPTT windows of every batch in closed form. A batch whose
+        sequences run from k_max down to k_min gets the windows [0, e) for
+        e in range(2, min(k_max, backward_size), step_size), then the
+        windows [k * step_size, k * step_size + backward_size) for k in
+        1 .. num_seg - 1, keeping those that start before k_min - 1.
+
+        :return: (lens, sizes, counts, starts, ends), the sequence lengths
+        and sizes of the batches, the number of windows of every batch and
+        the flat window bounds, batch after batch
+        """
+        sizes = np.array([len(b_ids) for b_ids in batch_indexes], dtype=np.int64)
+        if len(sizes) == 0:
+            empty = np.zeros(0, dtype=np.int64)
+            return empty, sizes, empty, empty, empty
+        lens = np.take(self.data_lens, np.concatenate(batch_indexes)).astype(np.int64)
+        firsts = np.cumsum(sizes) - sizes
+        max_lens, min_lens = lens[firsts], lens[firsts + sizes - 1]
+        # assume the b_ids are sorted from the longest
+        assert np.all(np.maximum.reduceat(lens, firsts) == max_lens)
+        assert np.all(np.minimum.reduceat(lens, firsts) == min_lens)
+
+        back, step = self.backward_size, self.step_size
+        num_head = np.maximum(0, -(-(np.minimum(max_lens, back) - 2) // step))
+        num_head[min_lens < 2] = 0
+        num_seg = (max_lens - back - step) // step
+        num_cut = np.minimum(np.maximum(num_seg - 1, 0),
+                             np.maximum(-(-(min_lens - 1) // step) - 1, 0))
+
+        counts = num_head + num_cut
+        pos = np.arange(np.sum(counts)) - np.repeat(np.cumsum(counts) - counts, counts)
+        heads = np.repeat(num_head, counts)
+        is_head = pos < heads
+        starts = np.where(is_head, 0, (pos - heads + 1) * step)
+        ends = np.where(is_head, 2 + pos * step, starts + back)
+        return lens, sizes, counts, starts, ends
+
+    def _log_padding(self, grid_b_ids, starts, ends):
+        """
+        :param grid_b_ids: the batch of every window in _grid_cache order
+        """
+        # a window (b_id, s_id, e_id) covers min(e_id, k_i) - s_id steps of every sequence
+        lens, sizes = self._grid_cache[3], self._grid_cache[4]
+        firsts = np.cumsum(sizes) - sizes
+        grid_sizes = sizes[grid_b_ids]
+        members = np.repeat(firsts[grid_b_ids], grid_sizes) + np.arange(np.sum(grid_sizes)) \
+            - np.repeat(np.cumsum(grid_sizes) - grid_sizes, grid_sizes)
+        used = np.sum(np.minimum(np.repeat(ends, grid_sizes), lens[members]) - np.repeat(starts, grid_sizes))
+        padded = np.sum(grid_sizes * (np.minimum(ends, lens[firsts[grid_b_ids]]) - starts))
+        self.logger.info("%s padding ratio %.3f" % (self.name, 1.0 - used / float(max(padded, 1))))
+
     def epoch_init(self, config, shuffle=True, verbose=True):
 
         assert len(self.indexes) == self.data_size and \
@@ -119,69 +431,61 @@ class LongDataLoader(object):
         self.backward_size = config.backward_size
         self.step_size = config.step_size
 
-        # create batch indexes
-        temp_num_batch = self.data_size // config.batch_size
-        self.batch_indexes = []
-        for i in range(temp_num_batch):
-            self.batch_indexes.append(
-                self.indexes[i * self.batch_size:(i + 1) * self.batch_size])
-
-        left_over = self.data_size - temp_num_batch * config.batch_size
+        # create batch indexes and their grids, which only change with the
+        # bucket sampler, otherwise shuffling just permutes them
+        bucket = getattr(config, 'batch_sampler', 'default') == 'bucket'
+        max_tokens = getattr(config, 'max_tokens_per_batch', 0)
+        key = (self.batch_size, self.backward_size, self.step_size, max_tokens)
+        if bucket or self._grid_cache is None or self._grid_cache[0] != key:
+            indexes = self._bucket_indexes(shuffle) if bucket else self.indexes
+            if max_tokens > 0:
+                batch_indexes = self._token_batches(indexes, max_tokens)
+                left_over = 0
+            else:
+                temp_num_batch = self.data_size // config.batch_size
+                batch_indexes = []
+                for i in range(temp_num_batch):
+                    batch_indexes.append(
+                        indexes[i * self.batch_size:(i + 1) * self.batch_size])
+                left_over = self.data_size - temp_num_batch * config.batch_size
+            self._grid_cache = (key, batch_indexes, left_over) + self._grid_table(batch_indexes)
+        _, batch_indexes, left_over, _, _, counts, starts, ends = self._grid_cache
+
+        # the same random draws as shuffling batch_indexes in place
+        order = np.arange(len(batch_indexes))
         if shuffle:
-            self._shuffle_batch_indexes()
-
-        # create grid indexes
-        self.grid_indexes = []
-        for idx, b_ids in enumerate(self.batch_indexes):
-            # assume the b_ids are sorted
-            all_lens = [self.data_lens[i] for i in b_ids]
-            max_len = self.data_lens[b_ids[0]]
-            min_len = self.data_lens[b_ids[-1]]
-            assert np.max(all_lens) == max_len
-            assert np.min(all_lens) == min_len
-            num_seg = (max_len - self.backward_size - self.step_size) // self.step_size
-            cut_start, cut_end = [], []
-            if num_seg > 1:
-                cut_start = list(range(config.step_size, num_seg * config.step_size, config.step_size))
-                cut_end = list(range(config.backward_size + config.step_size,
-                                num_seg * config.step_size + config.backward_size,
-                                config.step_size))
-                assert cut_end[-1] < max_len
-
-            actual_size = min(max_len, config.backward_size)
-            temp_end = list(range(2, actual_size, config.step_size))
-            temp_start = [0] * len(temp_end)
-
-            cut_start = temp_start + cut_start
-            cut_end = temp_end + cut_end
-
-            assert len(cut_end) == len(cut_start)
-            new_grids = [(idx, s_id, e_id) for s_id, e_id in
-                         zip(cut_start, cut_end) if s_id < min_len - 1]
-
-            self.grid_indexes.extend(new_grids)
+            np.random.shuffle(order)
+        self.batch_indexes = [batch_indexes[i] for i in order]
+
+        # gather the windows of every batch in the new order
+        new_counts = counts[order]
+        offsets = np.cumsum(counts) - counts
+        grid_pos = np.arange(np.sum(new_counts)) - np.repeat(np.cumsum(new_counts) - new_counts, new_counts)
+        rows = np.repeat(offsets[order], new_counts) + grid_pos
+        grid_b_ids = np.repeat(np.arange(len(order)), new_counts)
+        self.grid_indexes = list(zip(grid_b_ids.tolist(), starts[rows].tolist(), ends[rows].tolist()))
+        if verbose or shuffle:
+            self._log_padding(np.repeat(order, new_counts), starts[rows], ends[rows])
 
         # shuffle batch indexes
         if shuffle:
             self._shuffle_grid_indexes()
+        self.grid_indexes = self._shard(self.grid_indexes, shuffle)
 
         self.num_batch = len(self.grid_indexes)
         if verbose:
             self.logger.info("%s init with %d batches with %d left over samples" %
                              (self.name, self.num_batch, left_over))
+        self._init_batch_cache(config, shuffle)
 
-    def next_batch(self):
-        if self.ptr < self.num_batch:
-            current_grid = self.grid_indexes[self.ptr]
-            if self.ptr > 0:
-                prev_grid = self.grid_indexes[self.ptr - 1]
-            else:
-                prev_grid = None
-            self.ptr += 1
-            return self._prepare_batch(cur_grid=current_grid,
-                                       prev_grid=prev_grid)
-        else:
-            return None
+    def _get_batch(self, ptr):
+        """
+        Build the batch at position ptr of the epoch, without moving ptr
+        """
+        current_grid = self.grid_indexes[ptr]
+        prev_grid = self.grid_indexes[ptr - 1] if ptr > 0 else None
+        return self._prepare_batch(cur_grid=current_grid,
+                                   prev_grid=prev_grid)
 
     def pad_to(self, max_len, tokens, do_pad=True):
         if len(tokens) >= max_len:
@@ -191,3 +495,102 @@ class LongDataLoader(object):
         else:
             return tokens
 
+
+class WarmupMixin(object):
+    """
+    Mix batches of seed responses (warm up batches) into the epochs of a
+    DataLoader or LongDataLoader. The seed responses and actions are padded
+    once into dense matrices, an epoch draws its warm up batches from one
+    permutation of the seeds into a [num_batch, batch_size] index array,
+    and a warm up batch is a single gather.
+
+    The loader calls _init_warmup in __init__, _add_warmup in epoch_init on
+    its list of batches and implements _warmup_metas.
+
+    :ivar warmup_batches: the [warmup_num_batch, batch_size] seed ids of the epoch
+    :ivar warmup_flags: a bool array, True for the warm up batches of the epoch
+    """
+
+    def _init_warmup(self, warmup_data, config):
+        self.warmup_data = warmup_data
+        self.warmup_ratio = getattr(config, 'warmup_ratio', 0.0)
+        self.warmup_flags = None
+        self.warmup_num_batch = None
+        self.warmup_batches = None
+        self._pack_warmup()
+
+    def _pack_warmup(self):
+        # no seed responses, e.g. without action_match, add no warm up batches
+        if not self.warmup_data:
+            return
+        rows = self.warmup_data
+        self.warmup_size = len(rows)
+        self.warmup_lens = np.array([len(row.utt) for row in rows], dtype=np.int64)
+        self.warmup_act_lens = np.array([len(row.actions) for row in rows], dtype=np.int64)
+        self.warmup_utts = np.zeros((len(rows), max(self.warmup_lens.max(), 1)), dtype=self.id_dtype)
+        self.warmup_acts = np.zeros((len(rows), max(self.warmup_act_lens.max(), 1)), dtype=self.id_dtype)
+        for r_id, row in enumerate(rows):
+            self.warmup_utts[r_id, 0:len(row.utt)] = row.utt
+            self.warmup_acts[r_id, 0:len(row.actions)] = row.actions
+        self.warmup_domains = [row.domain for row in rows]
+        self.warmup_metas = self._warmup_metas(rows)
+
+    def _warmup_metas(self, rows):
+        """
+        :return: the domain_metas of every seed response as one array
+        """
+        raise NotImplementedError("Have to override warmup metas")
+
+    def _add_warmup(self, batches, config, shuffle, verbose):
+        """
+        :param batches: the dialog batches of the epoch
+        :return: batches with the warm up batches mixed in, num_batch counts
+        both. Like before, warmup_ratio 0 adds as many as the seeds fill,
+        otherwise that many warm up batches per dialog batch.
+        """
+        num_dialog = len(batches)
+        self.warmup_flags = np.zeros(num_dialog, dtype=bool)
+        if not self.warmup_data:
+            return batches
+
+        per_perm = self.warmup_size // config.batch_size
+        if self.warmup_ratio > 0:
+            # batches is the share of one rank, draw for all of them
+            shards = self.world_size if shuffle else 1
+            self.warmup_num_batch = int(round(self.warmup_ratio * num_dialog)) * shards if per_perm > 0 else 0
+        else:
+            self.warmup_num_batch = per_perm
+
+        # each batch has distinct seeds, it comes from one permutation
+        self.warmup_batches = np.zeros((self.warmup_num_batch, config.batch_size), dtype=np.int64)
+        for start in range(0, self.warmup_num_batch, max(per_perm, 1)):
+            num = min(per_perm, self.warmup_num_batch - start)
+            perm = np.random.permutation(self.warmup_size)
+            self.warmup_batches[start:start + num] = perm[0:num * config.batch_size].reshape(num, -1)
+
+        # like the dialog batches, every rank takes its share
+        self.warmup_batches = self._shard(self.warmup_batches, shuffle)
+        self.warmup_num_batch = len(self.warmup_batches)
+        batches = list(batches) + list(self.warmup_batches)
+        # the warm up batches come on top of the dialog batches
+        self.num_batch = len(batches)
+        self.warmup_flags = np.arange(len(batches)) >= num_dialog
+        if shuffle:
+            order = np.random.permutation(len(batches))
+            batches = [batches[i] for i in order]
+            self.warmup_flags = self.warmup_flags[order]
+
+        if verbose:
+            self.logger.info("%s add with %d warm up batches" % (self.name, self.warmup_num_batch))
+        return batches
+
+    def _prepare_warmup_batch(self, selected_ids):
+        selected_ids = np.asarray(selected_ids)
+        vec_out_lens = self.warmup_lens[selected_ids]
+        outputs = self._batch_field('outputs', self.warmup_utts[selected_ids, 0:np.max(vec_out_lens)])
+        output_actions = self._batch_field('output_actions', self.warmup_acts[
+            selected_ids, 0:np.max(self.warmup_act_lens[selected_ids])])
+        domain_metas = self._batch_field('domain_metas', self.warmup_metas[selected_ids])
+        domains = [self.warmup_domains[idx] for idx in selected_ids]
+        return Pack(output_lens=vec_out_lens, outputs=outputs, output_actions=output_actions,
+                    domains=domains, domain_metas=domain_metas)
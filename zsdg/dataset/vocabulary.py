@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+
+import numpy as np
+
+
+class _RevVocab(dict):
+    """word -> id, out of vocabulary words map to the UNK id in O(1)"""
+
+    def __init__(self, unk_id):
+        super(_RevVocab, self).__init__()
+        self.unk_id = unk_id
+
+    def __missing__(self, key):
+        if self.unk_id is None:
+            raise KeyError(key)
+        return self.unk_id
+
+
+class Vocabulary(object):
+    """
+    The word <-> id mapping shared by the corpora and the models. It behaves
+    like the old vocabulary list (len, indexing by id, iteration), maps
+    OOV words to UNK in O(1) and looks up the words of id arrays at once.
+
+    :ivar rev_vocab: a dict of word -> id, OOV words return unk_id
+    :ivar unk_id: the id of the UNK token
+    :ivar pad_id: the id of the PAD token
+    """
+
+    def __init__(self, words, unk=None, pad=None):
+        self.words = list(words)
+        self.unk = unk
+        self.pad = pad
+
+        # when a word appears twice, the later id wins
+        self.rev_vocab = _RevVocab(None)
+        for idx, word in enumerate(self.words):
+            self.rev_vocab[word] = idx
+        self.unk_id = self.words.index(unk) if unk in self.rev_vocab else None
+        self.pad_id = self.words.index(pad) if pad in self.rev_vocab else 0
+        self.rev_vocab.unk_id = self.unk_id
+
+        # id -> word, for lookup
+        self._id2word = np.array(self.words, dtype=object)
+
+    def __len__(self):
+        return len(self.words)
+
+    def __getitem__(self, idx):
+        return self.words[idx]
+
+    def __iter__(self):
+        return iter(self.words)
+
+    def __contains__(self, word):
+        return word in self.rev_vocab
+
+    def index(self, word):
+        return self.rev_vocab[word]
+
+    def lookup(self, ids):
+        """
+        :param ids: an int array of any shape
+        :return: an object array of words with the same shape
+        """
+        return self._id2word[np.asarray(ids)]
+
+    def to_array(self):
+        return np.array(self.words)
@@ -8,6 +8,7 @@ from zsdg.dataset.corpora import PAD, EOS, EOT
 from zsdg.enc2dec.decoders import TEACH_FORCE, GEN, DecoderRNN, DecoderPointerGen
 from zsdg.utils import get_dekenize
 import os
+import hashlib
 from collections import defaultdict
 import logging
 
@@ -16,8 +17,9 @@ def get_sent(model, de_tknize, data, b_id, attn=None, attn_ctx=None, stop_eos=Tr
     ws = []
     attn_ws = []
     has_attn = attn is not None and attn_ctx is not None
-    for t_id in range(data.shape[1]):
-        w = model.vocab[data[b_id, t_id]]
+    # translate the whole row at once instead of one id at a time
+    words = model.vocab.lookup(data[b_id])
+    for t_id, w in enumerate(words):
         if has_attn:
             a_val = np.max(attn[b_id, t_id])
             if a_val > 0.1:
@@ -42,28 +44,43 @@ def get_sent(model, de_tknize, data, b_id, attn=None, attn_ctx=None, stop_eos=Tr
 
 
 class LossManager(object):
+    """
+    Keep the losses of every batch. With a token budget batches hold
+    different numbers of examples, so the averages are weighted by the
+    weight given with each loss, e.g. the batch size.
+    """
     def __init__(self):
         self.losses = defaultdict(list)
+        self.weights = defaultdict(list)
         self.backward_losses = []
+        self.backward_weights = []
 
-    def add_loss(self, loss):
+    def add_loss(self, loss, weight=1.0):
         for key, val in loss.items():
             if val is not None and type(val) is not bool:
                 self.losses[key].append(val.data.item())
+                self.weights[key].append(weight)
 
-    def add_backward_loss(self, loss):
+    def add_backward_loss(self, loss, weight=1.0):
         self.backward_losses.append(loss.data.item())
+        self.backward_weights.append(weight)
 
     def clear(self):
         self.losses = defaultdict(list)
+        self.weights = defaultdict(list)
         self.backward_losses = []
+        self.backward_weights = []
 
     def pprint(self, name, window=None, prefix=None):
         str_losses = []
         for key, loss in self.losses.items():
             if loss is None:
                 continue
-            avg_loss = np.average(loss) if window is None else np.average(loss[-window:])
+            weights = self.weights[key]
+            if window is None:
+                avg_loss = np.average(loss, weights=weights)
+            else:
+                avg_loss = np.average(loss[-window:], weights=weights[-window:])
             str_losses.append("{} {:.3f}".format(key, avg_loss))
             if 'nll' in key:
                 str_losses.append("PPL {:.3f}".format(np.exp(avg_loss)))
@@ -73,7 +90,76 @@ class LossManager(object):
             return "{} {}".format(name, " ".join(str_losses))
 
     def avg_loss(self):
-        return np.mean(self.backward_losses)
+        if not self.backward_losses:
+            return np.nan
+        return np.average(self.backward_losses, weights=self.backward_weights)
+
+
+def resume_checkpoint(config):
+    """
+    :return: the checkpoint of config.resume_sess to continue from, or None
+    if there is nothing to resume
+    """
+    if getattr(config, 'resume_sess', None) is None:
+        return None
+    path = os.path.join(config.session_dir, "checkpoint")
+    return path if os.path.exists(path) else None
+
+
+def data_fingerprint(model, train_feed):
+    """
+    :return: a hash of the vocabulary and the training examples. The corpus
+    is rebuilt on resume, random draws without a cache or a seed may give
+    different ones.
+    """
+    md5 = hashlib.md5()
+    md5.update("\n".join(model.vocab).encode('utf-8'))
+    md5.update(train_feed.fingerprint().encode('utf-8'))
+    return md5.hexdigest()
+
+
+def save_checkpoint(path, model, optimizer, train_feed, config, **stats):
+    """
+    Save everything train needs to continue at the next batch: the model,
+    the optimizer, the training loader inside its epoch, the random states
+    and the early stopping stats. The file is replaced atomically.
+    """
+    state = dict(stats)
+    state['fingerprint'] = data_fingerprint(model, train_feed)
+    state['model'] = model.state_dict()
+    state['optimizer'] = optimizer.state_dict()
+    state['train_feed'] = train_feed.state_dict()
+    state['np_rng'] = np.random.get_state()
+    state['torch_rng'] = torch.get_rng_state()
+    if config.use_gpu:
+        state['cuda_rng'] = torch.cuda.get_rng_state_all()
+    tmp_path = path + '.tmp'
+    torch.save(state, tmp_path)
+    os.rename(tmp_path, path)
+
+
+def load_checkpoint(path, model, optimizer, train_feed, config):
+    """
+    Restore a save_checkpoint file into model, optimizer and train_feed.
+    :return: the dict of the other stats
+    """
+    try:
+        state = torch.load(path, weights_only=False)
+    except TypeError:
+        # torch before 1.13 has no weights_only and always unpickles
+        state = torch.load(path)
+    if state.pop('fingerprint') != data_fingerprint(model, train_feed):
+        raise ValueError("The vocabulary or the training dialogs differ from the run that saved {}. "
+                         "Rebuild the corpus the same way, e.g. from the corpus cache.".format(path))
+    model.load_state_dict(state.pop('model'))
+    optimizer.load_state_dict(state.pop('optimizer'))
+    train_feed.load_state_dict(state.pop('train_feed'))
+    np.random.set_state(state.pop('np_rng'))
+    torch.set_rng_state(state.pop('torch_rng'))
+    cuda_rng = state.pop('cuda_rng', None)
+    if cuda_rng is not None and config.use_gpu:
+        torch.cuda.set_rng_state_all(cuda_rng)
+    return state
 
 
 def train(model, train_feed, valid_feed, test_feed, config, evaluator, gen=None):
@@ -89,11 +175,29 @@ def train(model, train_feed, valid_feed, test_feed, config, evaluator, gen=None)
     train_loss = LossManager()
     model.train()
     logging.info(summary(model, show_weights=False))
-    logging.info("**** Training Begins ****")
-    logging.info("**** Epoch 0/{} ****".format(config.max_epoch))
+
+    # continue inside the epoch of the last checkpoint
+    resume_step = getattr(config, 'resume_step', 0)
+    checkpoint_path = os.path.join(config.session_dir, "checkpoint")
+    resumed = resume_checkpoint(config) is not None
+    if getattr(config, 'resume_sess', None) is not None and not resumed:
+        # e.g. preempted before the first checkpoint
+        logging.warning("No checkpoint at {}, training starts from scratch".format(checkpoint_path))
+    if resumed:
+        stats = load_checkpoint(checkpoint_path, model, optimizer, train_feed, config)
+        patience, valid_loss_threshold = stats['patience'], stats['valid_loss_threshold']
+        best_valid_loss, batch_cnt = stats['best_valid_loss'], stats['batch_cnt']
+        done_epoch, train_loss = stats['done_epoch'], stats['train_loss']
+        logging.info("**** Training Resumes at batch {} ****".format(batch_cnt))
+    else:
+        logging.info("**** Training Begins ****")
+    logging.info("**** Epoch {}/{} ****".format(done_epoch, config.max_epoch))
 
     while True:
-        train_feed.epoch_init(config, verbose=done_epoch==0, shuffle=True)
+        if resumed:
+            resumed = False
+        else:
+            train_feed.epoch_init(config, verbose=done_epoch==0, shuffle=True)
         while True:
             batch = train_feed.next_batch()
             if batch is None:
@@ -110,7 +214,7 @@ def train(model, train_feed, valid_feed, test_feed, config, evaluator, gen=None)
             model.backward(batch_cnt, loss)
             optimizer.step()
             batch_cnt += 1
-            train_loss.add_loss(loss)
+            train_loss.add_loss(loss, len(batch.outputs))
 
             if batch_cnt % config.print_step == 0:
                 logging.info(train_loss.pprint("Train", window=config.print_step,
@@ -159,6 +263,13 @@ def train(model, train_feed, valid_feed, test_feed, config, evaluator, gen=None)
                 logging.info("\n**** Epoch {}/{} ****".format(done_epoch,
                                                        config.max_epoch))
 
+            # after the evaluation, so the random state includes its shuffling
+            if resume_step > 0 and batch_cnt % resume_step == 0:
+                save_checkpoint(checkpoint_path, model, optimizer, train_feed, config,
+                                patience=patience, valid_loss_threshold=valid_loss_threshold,
+                                best_valid_loss=best_valid_loss, batch_cnt=batch_cnt,
+                                done_epoch=done_epoch, train_loss=train_loss)
+
 
 def validate(model, valid_feed, config, batch_cnt=None):
     model.eval()
@@ -169,8 +280,8 @@ def validate(model, valid_feed, config, batch_cnt=None):
         if batch is None:
             break
         loss = model(batch, mode=TEACH_FORCE)
-        losses.add_loss(loss)
-        losses.add_backward_loss(model.model_sel_loss(loss, batch_cnt))
+        losses.add_loss(loss, len(batch.outputs))
+        losses.add_backward_loss(model.model_sel_loss(loss, batch_cnt), len(batch.outputs))
 
     valid_loss = losses.avg_loss()
     logging.info(losses.pprint(valid_feed.name))
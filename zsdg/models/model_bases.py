@@ -10,6 +10,8 @@ from zsdg.utils import INT, FLOAT, LONG, cast_type
 import numpy as np
 import torch.nn.functional as F
 
+TORCH_DTYPES = {INT: torch.int32, LONG: torch.int64, FLOAT: torch.float32}
+
 
 def summary(model, show_weights=True, show_parameters=True):
     """
@@ -51,13 +53,29 @@ class BaseModel(nn.Module):
         self.flush_valid = False
         self.config = config
         self.kl_w = 0.0
+        self._ones = None
 
     def np2var(self, inputs, dtype):
         if inputs is None:
             return None
+        if torch.is_tensor(inputs):
+            # tensors from the loader are usually in the right dtype already
+            if inputs.dtype != TORCH_DTYPES[dtype]:
+                inputs = inputs.to(TORCH_DTYPES[dtype])
+            if self.use_gpu and not inputs.is_cuda:
+                inputs = inputs.cuda(non_blocking=True)
+            return inputs
         return cast_type(Variable(torch.from_numpy(inputs)), dtype,
                          self.use_gpu)
 
+    def ones_var(self, batch_size):
+        """
+        :return: a [batch_size, 1] FLOAT var of ones, reused across steps
+        """
+        if self._ones is None or self._ones.size(0) < batch_size:
+            self._ones = self.np2var(np.ones((batch_size, 1)), FLOAT)
+        return self._ones[0:batch_size]
+
     def forward(self, *input):
         raise NotImplementedError
 
@@ -339,7 +339,7 @@ class ZeroShotHRED(PtrBase):
         # required fields
         out_utts = self.np2var(data_feed['outputs'], LONG)
         batch_size = len(data_feed['outputs'])
-        out_confs = self.np2var(np.ones((batch_size, 1)), FLOAT)
+        out_confs = self.ones_var(batch_size)
 
         # forward pass
         out_embedded, out_outs, _, _ = self.utt_encoder(out_utts.unsqueeze(1), out_confs, return_all=True)
@@ -457,7 +457,7 @@ class ZeroShotPtrHRED(PtrBase):
         # required fields
         out_utts = self.np2var(data_feed['outputs'], LONG)
         batch_size = len(data_feed['outputs'])
-        out_confs = self.np2var(np.ones((batch_size, 1)), FLOAT)
+        out_confs = self.ones_var(batch_size)
 
         out_embedded, out_outs, _, _ = self.utt_encoder(out_utts.unsqueeze(1), out_confs, return_all=True)
         out_embedded = self.utt_policy(out_embedded.squeeze(1))
@@ -4,17 +4,21 @@
 from __future__ import print_function
 
 import os
+import io
 import json
 import logging
 from datetime import datetime
 import torch
 from nltk.tokenize.treebank import TreebankWordDetokenizer
-import nltk
 import sys
-from collections import defaultdict
+from collections import defaultdict, OrderedDict
 from argparse import Namespace
 import hashlib
 import random
+import itertools
+import numbers
+import multiprocessing
+import re
 
 INT = 0
 LONG = 1
@@ -86,11 +90,18 @@ def prepare_dirs_loggers(config, script=""):
     if not os.path.exists(config.log_dir):
         os.makedirs(config.log_dir)
 
-    dir_name = "{}-{}".format(get_time(), script) if script else get_time()
-    config_hash = hashlib.sha256(json.dumps(vars(config)).encode('utf-8')).hexdigest()[:8]
-    dir_name = "{}-{}".format(dir_name, config_hash)
-    config.session_dir = os.path.join(config.log_dir, dir_name)
-    os.mkdir(config.session_dir)
+    resume_sess = getattr(config, 'resume_sess', None)
+    if resume_sess is not None:
+        # keep logging into the session that is resumed
+        config.session_dir = os.path.join(config.log_dir, resume_sess)
+        if not os.path.exists(config.session_dir):
+            os.mkdir(config.session_dir)
+    else:
+        dir_name = "{}-{}".format(get_time(), script) if script else get_time()
+        config_hash = hashlib.sha256(json.dumps(vars(config)).encode('utf-8')).hexdigest()[:8]
+        dir_name = "{}-{}".format(dir_name, config_hash)
+        config.session_dir = os.path.join(config.log_dir, dir_name)
+        os.mkdir(config.session_dir)
 
     fileHandler = logging.FileHandler(os.path.join(config.session_dir,
                                                    'session.log'))
@@ -145,15 +156,194 @@ def get_dekenize():
     return lambda x: TreebankWordDetokenizer().detokenize(x)
 
 
+class Tokenizer(object):
+    """
+    A regex tokenizer that gives the same tokens as nltk.RegexpTokenizer
+    and memoizes string -> tokens in a bounded LRU cache, since most of the
+    utterances, acts and slots are generated from templates.
+
+    :ivar hits: the number of cached lookups
+    :ivar misses: the number of strings that were tokenized
+    """
+    def __init__(self, pattern, cache_size=200000):
+        # the same flags as nltk.RegexpTokenizer
+        self._regexp = re.compile(pattern, re.UNICODE | re.MULTILINE | re.DOTALL)
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self._move_to_end = getattr(self._cache, 'move_to_end', None)
+        self.hits = 0
+        self.misses = 0
+
+    def __call__(self, text):
+        return self.tokenize(text)
+
+    def tokenize(self, text):
+        tokens = self._cache.get(text)
+        if tokens is not None:
+            self.hits += 1
+            if self._move_to_end is not None:
+                self._move_to_end(text)
+            else:
+                del self._cache[text]
+                self._cache[text] = tokens
+        else:
+            self.misses += 1
+            tokens = tuple(self._regexp.findall(text))
+            self._cache[text] = tokens
+            if len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        # callers extend the token list, so never hand out the cached copy
+        return list(tokens)
+
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return float(self.hits) / total if total > 0 else 0.0
+
+    def summary(self):
+        return "Tokenizer cache size %d, hits %d, misses %d, hit rate %.4f" \
+               % (len(self._cache), self.hits, self.misses, self.hit_rate())
+
+
+_tokenizers = {}
+
+
+def _get_tokenizer(pattern):
+    if pattern not in _tokenizers:
+        _tokenizers[pattern] = Tokenizer(pattern)
+    return _tokenizers[pattern]
+
+
 def get_tokenize():
-    return nltk.RegexpTokenizer(r'\w+|#\w+|<\w+>|%\w+|[^\w\s]+').tokenize
+    return _get_tokenizer(r'\w+|#\w+|<\w+>|%\w+|[^\w\s]+')
 
 
 def get_chat_tokenize():
-    return nltk.RegexpTokenizer(r'\w+|<sil>|[^\w\s]+').tokenize
+    return _get_tokenizer(r'\w+|<sil>|[^\w\s]+')
 
 
 class missingdict(defaultdict):
     def __missing__(self, key):
         return self.default_factory()
 
+
+
+def get_worker_pool(num_workers):
+    """
+    :return: a process pool if num_workers > 1 else None
+    """
+    if num_workers is None or num_workers <= 1:
+        return None
+    return multiprocessing.Pool(num_workers)
+
+
+def parallel_map(func, iterable, pool=None, num_workers=1, chunk_size=64):
+    """
+    An ordered map that shards the work over a process pool. The input is
+    consumed one window at a time, such that a streamed input is never
+    fully resident. func must be picklable, i.e. a module level function
+    or a functools.partial of one.
+
+    :param pool: a multiprocessing.Pool or None for the serial path
+    :param num_workers: the number of processes of pool, as given to get_worker_pool
+    :return: a generator of func(x) in the order of iterable
+    """
+    if pool is None:
+        for x in iterable:
+            yield func(x)
+        return
+
+    window_size = chunk_size * max(num_workers, 1) * 4
+    iterator = iter(iterable)
+    while True:
+        window = list(itertools.islice(iterator, window_size))
+        if not window:
+            break
+        for result in pool.map(func, window, chunk_size):
+            yield result
+
+
+class _JsonStream(object):
+    """A buffered reader that decodes one JSON value at a time from a file"""
+
+    def __init__(self, f, chunk_size):
+        self.f = f
+        self.chunk_size = chunk_size
+        self.decoder = json.JSONDecoder()
+        self.buf = ''
+        self.pos = 0
+        self.eof = False
+
+    def _fill(self):
+        # read at least as much as we hold, so re-parsing a large value is amortized
+        chunk = self.f.read(max(self.chunk_size, len(self.buf) - self.pos))
+        self.eof = not chunk
+        self.buf = self.buf[self.pos:] + chunk
+        self.pos = 0
+
+    def _skip_ws(self):
+        while True:
+            while self.pos < len(self.buf) and self.buf[self.pos] in ' \t\n\r':
+                self.pos += 1
+            if self.pos < len(self.buf) or self.eof:
+                return
+            self._fill()
+
+    def peek(self):
+        self._skip_ws()
+        return self.buf[self.pos] if self.pos < len(self.buf) else ''
+
+    def take(self, expected=None):
+        c = self.peek()
+        if expected is not None and c not in expected:
+            raise ValueError("Expect one of {} but got '{}'".format(expected, c))
+        self.pos += 1
+        return c
+
+    def decode(self):
+        self._skip_ws()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buf, self.pos)
+                # a number may be cut by the end of the buffer, e.g. after
+                # its '.' or 'e', it is complete once a delimiter follows
+                if self.eof or not isinstance(value, numbers.Number) or \
+                        (end < len(self.buf) and self.buf[end] in ',]} \t\n\r'):
+                    self.pos = end
+                    return value
+            except ValueError:
+                if self.eof:
+                    raise
+            self._fill()
+
+
+def iter_json_items(path, stream_key, chunk_size=1 << 16):
+    """
+    Incrementally parse a JSON file whose top level is an object. The value
+    of stream_key must be a list and is yielded one element at a time as
+    (stream_key, element). Every other key is yielded as (key, value).
+
+    :param path: the JSON file
+    :param stream_key: the key of the list to stream
+    :return: a generator of (key, value)
+    """
+    with io.open(path, 'r', encoding='utf-8') as f:
+        stream = _JsonStream(f, chunk_size)
+        stream.take('{')
+        if stream.peek() == '}':
+            return
+        while True:
+            key = stream.decode()
+            stream.take(':')
+            if key == stream_key:
+                stream.take('[')
+                if stream.peek() == ']':
+                    stream.take()
+                else:
+                    while True:
+                        yield key, stream.decode()
+                        if stream.take(',]') == ']':
+                            break
+            else:
+                yield key, stream.decode()
+            if stream.take(',}') == '}':
+                break